@@ -1,121 +1,180 @@
+from __future__ import annotations
+
 import asyncio
-from math import inf
-import os
-import pickle
 from contextlib import asynccontextmanager
-from typing import List
-
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import SimpleSpanProcessor
-
-from .essentials import Engine, config, get_db, logger, meta_config
-from .models import Base, User
-from .router import user_router, auth_router
-from .utils import _clean_up_expired_tokens, register_user
-
-import Akatosh
-from Akatosh.universe import Mundus
-
-
-# define lifespan
-@asynccontextmanager
-async def _lifespan(app: FastAPI):
-    Base.metadata.create_all(bind=Engine)
+from math import inf
+from typing import TYPE_CHECKING, Optional
+
+from . import logger
+
+if TYPE_CHECKING:
+    from fastapi import FastAPI
+
+    from .settings import Settings
+
+
+async def setup_database(settings: Optional[Settings] = None):
+    """Migrates and creates the tables and imports the queued users and the seed file.
+
+    Concurrent runs race on the migrations and the seed imports, so it runs once per
+    deployment before workers serve requests. The application runs it on startup
+    unless DATABASE_SETUP is off, which the launcher turns off in its workers after
+    running it once itself.
+
+    Args:
+        settings (Optional[Settings], optional): the settings, loaded from the configuration files and the environment if None. Defaults to None.
+    """
+    from .settings import configure, get_settings
+
+    if settings is not None:
+        configure(settings)
+    settings = get_settings()
+
+    from .essentials import init_db, run_ddl
+    from .migrations import migrate_database
+    from .models import Base
+    from .seed import BOOTSTRAP_FILE, import_seed, migrate_legacy_bootstrap
+
+    await run_ddl(migrate_database)
+    await init_db(Base.metadata)
     logger.debug("Database initialized.")
-    db = next(get_db())
-    try:
-        with open(".superuser", "rb") as f:
-            superusers: List[User] = pickle.load(f)
-            for superuser in superusers:
-                try:
-                    register_user(superuser)
-                except HTTPException:
-                    logger.debug(f"Superuser {superuser.username} already exists.")
-        os.remove(".superuser")
-    except FileNotFoundError:
-        pass
-
-    try:
-        with open(".users", "rb") as f:
-            users: List[User] = pickle.load(f)
-            for user in users:
-                try:
-                    register_user(user)
-                except HTTPException:
-                    logger.debug(f"User {user.username} already exists.")
-        os.remove(".users")
-    except FileNotFoundError:
-        pass
+    migrate_legacy_bootstrap()
+    await import_seed(BOOTSTRAP_FILE, chunk_size=settings.SEED_CHUNK_SIZE, remove=True)
+    if settings.SEED_FILE:
+        await import_seed(settings.SEED_FILE, chunk_size=settings.SEED_CHUNK_SIZE)
     logger.debug("Superusers and users registered.")
-    expired_token_cleaner = asyncio.create_task(_clean_up_expired_tokens())
-    Mundus.enable_realtime()
-    Akatosh.logger.setLevel("INFO")
-    akatosh = asyncio.create_task(Mundus.simulate(inf))
-    yield
-    expired_token_cleaner.cancel()
-    akatosh.cancel()
-
-
-# define app
-app = FastAPI(
-    debug=bool(os.getenv("DEBUG", meta_config.get("DEBUG", False))),
-    title=os.getenv("TITLE", meta_config.get("TITLE", "FasterAPI")),
-    description=os.getenv(
-        "DESCRIPTION",
-        meta_config.get(
-            "DESCRIPTION",
-            "A FastAPI starter template with prebuilt JWT auth system.",
-        ),
-    ),
-    version=os.getenv("VERSION", meta_config.get("VERSION", "0.0.1")),
-    openapi_url=os.getenv(
-        "OPENAPI_URL", meta_config.get("OPENAPI_URL", "/openapi.json")
-    ),
-    docs_url=os.getenv("DOCS_URL", meta_config.get("DOCS_URL", "/docs")),
-    redoc_url=os.getenv("REDOC_URL", meta_config.get("REDOC_URL", "/redoc")),
-    terms_of_service=os.getenv(
-        "TERMS_OF_SERVICE", meta_config.get("TERMS_OF_SERVICE", None)
-    ),
-    contact=os.getenv("CONTACT", meta_config.get("CONTACT", None)),  # type: ignore
-    summary=os.getenv("SUMMARY", meta_config.get("SUMMARY", None)),
-    lifespan=_lifespan,
-)
-
-allow_origins = os.getenv("ALLOWED_ORIGINS", config.get("ALLOWED_ORIGINS", ["*"]))
-allow_credentials = bool(
-    os.getenv("ALLOW_CREDENTIALS", config.get("ALLOW_CREDENTIALS", True))
-)
-allow_methods = os.getenv("ALLOW_METHODS", config.get("ALLOW_METHODS", ["*"]))
-allow_headers = os.getenv("ALLOW_HEADERS", config.get("ALLOW_HEADERS", ["*"]))
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allow_origins,
-    allow_credentials=allow_credentials,
-    allow_methods=allow_methods,
-    allow_headers=allow_headers,
-)
-
-app.include_router(auth_router)
-app.include_router(user_router)
-
-if meta_config.get("TRACE", False):
-    exporter = OTLPSpanExporter(
-        endpoint=meta_config.get("TRACE_ENDPOINT", "localhost:4317"),
-        insecure=True,
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """Builds the FasterAPI application.
+
+    Nothing is configured or imported until this is called, so importing this module
+    is cheap, e.g. in the parent of pre-forked workers. Tracing and the Akatosh
+    scheduler are only imported when enabled.
+
+    Args:
+        settings (Optional[Settings], optional): the settings, loaded from the configuration files and the environment if None. Defaults to None.
+
+    Returns:
+        FastAPI: returns the application.
+    """
+    from .settings import configure, get_settings
+
+    if settings is not None:
+        configure(settings)
+    settings = get_settings()
+
+    from fastapi import FastAPI
+    from fastapi.middleware.cors import CORSMiddleware
+
+    from .essentials import open_db
+    from .hashing import password_hasher
+    from .keypool import key_pool
+    from .keyring import keyring
+    from .metrics import MetricsMiddleware
+    from .ratelimit import rate_limiter
+    from .reaper import _reap_expired_rows
+    from .replica import _monitor_replicas, replica_router
+    from .revocation import revocation_index
+    from .router import auth_router, metrics_router, user_router
+    from .store import session_store
+    from .utils import (_rotate_signing_keys, _sync_revocation_index, dummy_hash,
+                        load_revocation_index)
+
+    # define lifespan
+    @asynccontextmanager
+    async def _lifespan(app: FastAPI):
+        if settings.DATABASE_SETUP:
+            await setup_database()
+        # hashed up front so the first login with an unknown username is not faster
+        await dummy_hash()
+        reaper = None
+        if settings.SINGLETON_JOBS:
+            reaper = asyncio.create_task(_reap_expired_rows())
+        key_rotator = None
+        if keyring is not None:
+            # other workers only pick up the keys rotated by the singleton one
+            key_rotator = asyncio.create_task(
+                _rotate_signing_keys(rotate=settings.SINGLETON_JOBS)
+            )
+        revocation_index_sync = None
+        if revocation_index.enabled:
+            async with open_db() as db:
+                loaded = await load_revocation_index(db)
+            logger.debug(f"Revocation index loaded with {loaded} tokens.")
+            revocation_index_sync = asyncio.create_task(_sync_revocation_index())
+        replica_monitor = None
+        if replica_router.enabled:
+            # only the singleton worker writes the heartbeat the replicas are measured by
+            replica_monitor = asyncio.create_task(
+                _monitor_replicas(heartbeat=settings.SINGLETON_JOBS)
+            )
+        if key_pool.enabled:
+            await key_pool.start()
+        akatosh = None
+        if settings.SCHEDULER and settings.SINGLETON_JOBS:
+            import Akatosh
+            from Akatosh.universe import Mundus
+
+            Mundus.enable_realtime()
+            Akatosh.logger.setLevel("INFO")
+            akatosh = asyncio.create_task(Mundus.simulate(inf))
+        yield
+        if reaper is not None:
+            reaper.cancel()
+        if revocation_index_sync is not None:
+            revocation_index_sync.cancel()
+        if key_rotator is not None:
+            key_rotator.cancel()
+        if replica_monitor is not None:
+            replica_monitor.cancel()
+        if akatosh is not None:
+            akatosh.cancel()
+        await key_pool.stop()
+        await session_store.close()
+        await rate_limiter.close()
+        password_hasher.shutdown()
+
+    # define app
+    app = FastAPI(
+        debug=settings.DEBUG,
+        title=settings.TITLE,
+        description=settings.DESCRIPTION,
+        version=settings.VERSION,
+        openapi_url=settings.OPENAPI_URL,
+        docs_url=settings.DOCS_URL,
+        redoc_url=settings.REDOC_URL,
+        terms_of_service=settings.TERMS_OF_SERVICE or None,
+        contact=settings.CONTACT or None,  # type: ignore
+        summary=settings.SUMMARY,
+        lifespan=_lifespan,
     )
+    app.state.settings = settings
 
-    trace_provider = TracerProvider(
-        resource=Resource(
-            attributes={"service.name": meta_config.get("SVC_NAME", "FasterAPI")}
-        )
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=settings.ALLOWED_ORIGINS,
+        allow_credentials=settings.ALLOW_CREDENTIALS,
+        allow_methods=settings.ALLOW_METHODS,
+        allow_headers=settings.ALLOW_HEADERS,
     )
-    trace_provider.add_span_processor(SimpleSpanProcessor(exporter))
-    trace.set_tracer_provider(tracer_provider=trace_provider)
-    FastAPIInstrumentor().instrument_app(app)
+
+    app.include_router(auth_router)
+    app.include_router(user_router)
+    if settings.METRICS:
+        app.add_middleware(MetricsMiddleware)
+        app.include_router(metrics_router)
+
+    if settings.TRACE:
+        from .tracing import setup_tracing
+
+        setup_tracing(app, settings)
+    return app
+
+
+def __getattr__(name: str):
+    # `from FasterAPI.app import app` builds the default application on first use
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
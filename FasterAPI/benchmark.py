@@ -0,0 +1,228 @@
+"""Micro-benchmarks, run with `python -m FasterAPI.benchmark <command>`."""
+
+import argparse
+import os
+import secrets
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .settings import get_settings
+
+# measured by the import benchmark when no targets are given
+IMPORT_TARGETS = [
+    "FasterAPI.settings",
+    "FasterAPI.cert",
+    "FasterAPI.schemas",
+    "FasterAPI.app",
+    "FasterAPI.essentials",
+    "create_app",
+]
+
+
+def _hash_settings(args: argparse.Namespace) -> Iterator[Tuple[str, str, Dict]]:
+    """Yields (scheme, label, context options) for every setting to measure."""
+    for scheme in args.schemes:
+        if scheme == "bcrypt":
+            for rounds in args.bcrypt_rounds:
+                yield "bcrypt", f"bcrypt rounds={rounds}", {"bcrypt_rounds": rounds}
+        elif scheme == "argon2":
+            for time_cost in args.argon2_time_cost:
+                for memory_cost in args.argon2_memory_cost:
+                    yield (
+                        "argon2",
+                        f"argon2id t={time_cost} m={memory_cost} "
+                        f"p={args.argon2_parallelism}",
+                        {
+                            "argon2_time_cost": time_cost,
+                            "argon2_memory_cost": memory_cost,
+                            "argon2_parallelism": args.argon2_parallelism,
+                        },
+                    )
+        else:
+            yield scheme, scheme, {}
+
+
+def benchmark_hash(
+    scheme: str, duration: float = 2.0, min_iterations: int = 3, **options
+) -> Tuple[int, float]:
+    """Hashes random passwords on one core for at least the duration.
+
+    Args:
+        scheme (str): the passlib scheme.
+        duration (float, optional): the minimum seconds to run. Defaults to 2.0.
+        min_iterations (int, optional): the minimum hashes to run. Defaults to 3.
+
+    Returns:
+        Tuple[int, float]: returns the number of hashes and the seconds they took.
+    """
+    from .essentials import make_crypt_context
+
+    context = make_crypt_context([scheme], **options)
+    # the first hash loads the backend and is not timed
+    context.hash(secrets.token_urlsafe(16))
+    iterations = 0
+    start = perf_counter()
+    while iterations < min_iterations or perf_counter() - start < duration:
+        context.hash(secrets.token_urlsafe(16))
+        iterations += 1
+    return iterations, perf_counter() - start
+
+
+def _run_hash(args: argparse.Namespace):
+    print(
+        f"{'setting':<36} {'ms/hash':>9} {'hashes/s/core':>14} "
+        f"{'hashes/s x' + str(args.workers):>14}"
+    )
+    for scheme, label, options in _hash_settings(args):
+        try:
+            iterations, elapsed = benchmark_hash(scheme, args.duration, **options)
+        except Exception as e:
+            print(f"{label:<36} unavailable: {e}")
+            continue
+        latency = elapsed / iterations
+        line = (
+            f"{label:<36} {latency * 1000:>9.1f} {1 / latency:>14.1f} "
+            f"{args.workers / latency:>14.1f}"
+        )
+        if args.target_ms is not None:
+            line += "  ok" if latency * 1000 <= args.target_ms else "  over target"
+        print(line)
+
+
+def _import_code(target: str) -> str:
+    if target == "create_app":
+        statement = "from FasterAPI.app import create_app; create_app()"
+    else:
+        statement = f"import {target}"
+    return (
+        "from time import perf_counter; start = perf_counter(); "
+        f"{statement}; print(perf_counter() - start)"
+    )
+
+
+def benchmark_import(target: str, repeat: int = 5) -> List[float]:
+    """Imports the module in fresh interpreters, as a cold worker would.
+
+    Args:
+        target (str): the module, or "create_app" to also build the application.
+        repeat (int, optional): the number of interpreters to start. Defaults to 5.
+
+    Returns:
+        List[float]: returns the seconds each import took.
+    """
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", _import_code(target)],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def slowest_imports(target: str, top: int = 10) -> List[Tuple[int, str]]:
+    """Returns the (cumulative microseconds, module) of the slowest imports of the target."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _import_code(target)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def _run_import(args: argparse.Namespace):
+    over_budget = False
+    print(f"{'target':<24} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for target in args.targets:
+        timings = benchmark_import(target, args.repeat)
+        median = statistics.median(timings) * 1000
+        line = (
+            f"{target:<24} {median:>10.1f} {min(timings) * 1000:>8.1f} "
+            f"{max(timings) * 1000:>8.1f}"
+        )
+        if args.budget_ms is not None and median > args.budget_ms:
+            over_budget = True
+            line += "  over budget"
+        print(line)
+        if args.top:
+            for cumulative, module in slowest_imports(target, args.top):
+                print(f"    {cumulative / 1000:>8.1f} ms  {module}")
+    if over_budget:
+        sys.exit(1)
+
+
+def main(argv: Optional[List[str]] = None):
+    settings = get_settings()
+    parser = argparse.ArgumentParser(prog="python -m FasterAPI.benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+    hash_parser = commands.add_parser(
+        "hash",
+        help="measure password hashes per second per core for each scheme and cost",
+    )
+    hash_parser.add_argument("--schemes", nargs="+", default=settings.PASSWORD_SCHEMES)
+    hash_parser.add_argument(
+        "--bcrypt-rounds", nargs="+", type=int, default=[settings.BCRYPT_ROUNDS]
+    )
+    hash_parser.add_argument(
+        "--argon2-time-cost", nargs="+", type=int, default=[settings.ARGON2_TIME_COST]
+    )
+    hash_parser.add_argument(
+        "--argon2-memory-cost",
+        nargs="+",
+        type=int,
+        default=[settings.ARGON2_MEMORY_COST],
+    )
+    hash_parser.add_argument(
+        "--argon2-parallelism", type=int, default=settings.ARGON2_PARALLELISM
+    )
+    hash_parser.add_argument(
+        "--duration", type=float, default=2.0, help="seconds to run each setting"
+    )
+    hash_parser.add_argument(
+        "--workers",
+        type=int,
+        default=min(settings.HASH_WORKERS, os.cpu_count() or 1),
+        help="cores to extrapolate the total throughput to",
+    )
+    hash_parser.add_argument(
+        "--target-ms", type=float, help="flag settings slower than this latency"
+    )
+    hash_parser.set_defaults(run=_run_hash)
+    import_parser = commands.add_parser(
+        "import",
+        help="measure the cold import time of modules in fresh interpreters",
+    )
+    import_parser.add_argument(
+        "targets",
+        nargs="*",
+        default=IMPORT_TARGETS,
+        help='modules to import, "create_app" also builds the application',
+    )
+    import_parser.add_argument("--repeat", type=int, default=5)
+    import_parser.add_argument(
+        "--top", type=int, default=0, help="list the slowest imports of each target"
+    )
+    import_parser.add_argument(
+        "--budget-ms",
+        type=float,
+        help="exit with status 1 if a median import time exceeds it",
+    )
+    import_parser.set_defaults(run=_run_import)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
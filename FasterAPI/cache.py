@@ -0,0 +1,235 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+
+from .essentials import TOKEN_CACHE_SIZE, USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL
+from .metrics import Counter, Gauge, registry
+from .models import User, UserPrivilege
+
+
+def token_digest(token: str) -> str:
+    """Returns the SHA-256 hex digest of the token."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def session_digest(sid: str) -> str:
+    """Returns the digest under which the session is revoked."""
+    return hashlib.sha256(f"sid:{sid}".encode()).hexdigest()
+
+
+@dataclass
+class CachedToken:
+    """A verified token together with the user state it was checked against."""
+
+    claims: Dict
+    exp: float
+    user_id: int
+    username: str
+    first_name: str
+    last_name: str
+    email: str
+    is_superuser: bool
+    privileges: FrozenSet[str] = field(default_factory=frozenset)
+    session: Optional[str] = None
+
+    def to_user(self) -> User:
+        """Builds a detached snapshot of the user. Re-query it if you intend to modify it."""
+        return User(
+            id=self.user_id,
+            username=self.username,
+            first_name=self.first_name,
+            last_name=self.last_name,
+            email=self.email,
+            is_superuser=self.is_superuser,
+            privileges=[UserPrivilege(privilege=p) for p in sorted(self.privileges)],
+        )
+
+
+class TokenCache:
+    """A bounded LRU cache of verified tokens, each expiring at the token's exp."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, CachedToken]" = OrderedDict()
+        self._by_user: Dict[str, Set[str]] = {}
+        self._by_session: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def get(self, token: str) -> Optional[CachedToken]:
+        """Returns the cached entry of the token, or None if absent or expired."""
+        if not self.enabled:
+            return None
+        key = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.exp <= time.time():
+                self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, token: str, entry: CachedToken):
+        """Caches a verified token, evicting the least recently used entry if full."""
+        if not self.enabled:
+            return
+        key = token_digest(token)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = entry
+            self._by_user.setdefault(entry.username, set()).add(key)
+            if entry.session is not None:
+                self._by_session.setdefault(entry.session, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, token: str):
+        """Drops the cached entry of the token."""
+        self.invalidate_digest(token_digest(token))
+
+    def invalidate_digest(self, digest: str):
+        """Drops the cached entry of the token, or every token of the session, with the hex digest."""
+        with self._lock:
+            self._discard(digest)
+            for key in list(self._by_session.get(digest, ())):
+                self._discard(key)
+
+    def invalidate_user(self, username: str):
+        """Drops every cached token of the user."""
+        with self._lock:
+            for key in list(self._by_user.get(username, ())):
+                self._discard(key)
+
+    def clear(self):
+        """Drops every cached token."""
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self._by_session.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit/miss counters and the current size."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for index, name in (
+            (self._by_user, entry.username),
+            (self._by_session, entry.session),
+        ):
+            keys = index.get(name)  # type: ignore
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[name]  # type: ignore
+
+
+token_cache = TokenCache(maxsize=TOKEN_CACHE_SIZE)
+
+
+class UsernameCache:
+    """A bounded LRU cache of whether usernames exist, each entry expiring after ttl seconds.
+
+    Entries written by other workers are not seen, so a user created elsewhere may be
+    reported missing by this worker until its entry expires. Keep the ttl short.
+    """
+
+    def __init__(self, maxsize: int = 100_000, ttl: float = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, username: str) -> Optional[bool]:
+        """Returns whether the username exists, or None if unknown."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(username, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, username: str, exists: bool):
+        """Records whether the username exists."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries.pop(username, None)
+            self._entries[username] = (exists, time.monotonic() + self.ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self._entries.clear()
+
+
+username_cache = UsernameCache(maxsize=USERNAME_CACHE_SIZE, ttl=USERNAME_CACHE_TTL)
+
+registry.register(
+    Counter(
+        "fasterapi_token_cache_hits_total",
+        "Verified token cache hits.",
+        callback=lambda: token_cache.hits,
+    )
+)
+registry.register(
+    Counter(
+        "fasterapi_token_cache_misses_total",
+        "Verified token cache misses.",
+        callback=lambda: token_cache.misses,
+    )
+)
+registry.register(
+    Gauge(
+        "fasterapi_token_cache_size",
+        "Tokens in the verified token cache.",
+        callback=lambda: len(token_cache._entries),
+    )
+)
+registry.register(
+    Counter(
+        "fasterapi_username_cache_hits_total",
+        "Username existence cache hits.",
+        callback=lambda: username_cache.hits,
+    )
+)
+registry.register(
+    Counter(
+        "fasterapi_username_cache_misses_total",
+        "Username existence cache misses.",
+        callback=lambda: username_cache.misses,
+    )
+)
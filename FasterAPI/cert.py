@@ -1,19 +1,83 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Any, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple, Union
 
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
 from cryptography.x509 import Certificate, CertificateSigningRequest
 from cryptography.x509.oid import NameOID
 
+if TYPE_CHECKING:
+    from .keypool import KeyPool
+
+_EC_CURVES = {256: ec.SECP256R1, 384: ec.SECP384R1, 521: ec.SECP521R1}
+
+PrivateKey = Union[
+    rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey, ed25519.Ed25519PrivateKey
+]
+
+
+def generate_private_key(
+    key_type: str = "rsa", key_size: Optional[int] = None
+) -> PrivateKey:
+    """Generate a private key.
+
+    EC and Ed25519 keys are generated in well under a millisecond, RSA keys take
+    hundreds.
+
+    Args:
+        key_type (str, optional): the key type, "rsa", "ec" or "ed25519". Defaults to "rsa".
+        key_size (Optional[int], optional): the RSA modulus size, or the EC curve size (256, 384 or 521). Ignored for Ed25519. Defaults to 2048 for RSA and 256 for EC.
+
+    Raises:
+        ValueError: raise if the key type or the curve size is not supported.
+
+    Returns:
+        PrivateKey: returns the private key.
+    """
+    if key_type == "rsa":
+        return rsa.generate_private_key(
+            public_exponent=65537, key_size=key_size or 2048, backend=default_backend()
+        )
+    if key_type == "ec":
+        key_size = key_size or 256
+        if key_size not in _EC_CURVES:
+            raise ValueError(f"Unsupported EC curve size {key_size}.")
+        return ec.generate_private_key(_EC_CURVES[key_size](), default_backend())
+    if key_type == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError(f"Unsupported key type {key_type}.")
+
+
+def _signature_hash(key: PrivateKey) -> Optional[hashes.HashAlgorithm]:
+    # Ed25519 signs the message itself, without a separate digest
+    if isinstance(key, ed25519.Ed25519PrivateKey):
+        return None
+    return hashes.SHA256()
+
+
+def _private_key_pem(key: PrivateKey) -> bytes:
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
 def generate_root_ca(
     expiration_days: int = 3650,
     common_name: str = "Root CA",
     subject_alternative_names: Optional[List[str]] = None,
     directory: Optional[str] = None,
-) -> Tuple[rsa.RSAPrivateKey, Certificate]:
+    key_type: str = "rsa",
+    key_size: Optional[int] = None,
+) -> Tuple[PrivateKey, Certificate]:
     """Create a root CA certificate and private key.
 
     Args:
@@ -21,14 +85,14 @@ def generate_root_ca(
         common_name (str, optional): the common name. Defaults to "Root CA".
         subject_alternative_names (Optional[List[str]], optional): the subject alternative names. Defaults to None.
         directory (Optional[str], optional): the directory to save the files. Defaults to None.
+        key_type (str, optional): the key type, "rsa", "ec" or "ed25519". Defaults to "rsa".
+        key_size (Optional[int], optional): the RSA modulus size or the EC curve size. Defaults to 2048 for RSA and 256 for EC.
 
     Returns:
-        Tuple[rsa.RSAPrivateKey, Certificate]: returns the CA key and certifcate
+        Tuple[PrivateKey, Certificate]: returns the CA key and certifcate
     """
 
-    key = rsa.generate_private_key(
-        public_exponent=65537, key_size=2048, backend=default_backend()
-    )
+    key = generate_private_key(key_type, key_size)
 
     subject = issuer = x509.Name(
         [
@@ -54,17 +118,11 @@ def generate_root_ca(
             [x509.DNSName(name) for name in subject_alternative_names]
         )
         builder = builder.add_extension(san_dns_names, critical=False)
-    cert = builder.sign(key, hashes.SHA256(), default_backend())
+    cert = builder.sign(key, _signature_hash(key), default_backend())
 
     if directory:
         with open(f"{directory}/root-key.pem", "wb") as f:
-            f.write(
-                key.private_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PrivateFormat.TraditionalOpenSSL,
-                    encryption_algorithm=serialization.NoEncryption(),
-                )
-            )
+            f.write(_private_key_pem(key))
         with open(f"{directory}/root-cert.pem", "wb") as f:
             f.write(cert.public_bytes(encoding=serialization.Encoding.PEM))
 
@@ -72,8 +130,14 @@ def generate_root_ca(
 
 
 def generate_key_and_csr(
-    common_name: str, san_dns_names: List[str], san_uris: Optional[List[str]] = None, directory: Optional[str] = None
-) -> Tuple[rsa.RSAPrivateKey, CertificateSigningRequest]:
+    common_name: str,
+    san_dns_names: List[str],
+    san_uris: Optional[List[str]] = None,
+    directory: Optional[str] = None,
+    key_type: str = "rsa",
+    key_size: Optional[int] = None,
+    key: Optional[PrivateKey] = None,
+) -> Tuple[PrivateKey, CertificateSigningRequest]:
     """Generate a private key and certificate signing request (CSR).
 
     Args:
@@ -81,13 +145,15 @@ def generate_key_and_csr(
         san_dns_names (List[str]): the subject alternative names of the server.
         san_uris (Optional[List[str]], optional): the subject alternative URIs of the server. Defaults to None.
         directory (Optional[str], optional): the directory to save the files. Defaults to None.
+        key_type (str, optional): the key type, "rsa", "ec" or "ed25519". Defaults to "rsa".
+        key_size (Optional[int], optional): the RSA modulus size or the EC curve size. Defaults to 2048 for RSA and 256 for EC.
+        key (Optional[PrivateKey], optional): an existing key to use instead of generating one. Defaults to None.
 
     Returns:
-        Certificate: returns the sever private key and certifcate signing request.
+        Tuple[PrivateKey, CertificateSigningRequest]: returns the sever private key and certifcate signing request.
     """
-    key = rsa.generate_private_key(
-        public_exponent=65537, key_size=2048, backend=default_backend()
-    )
+    if key is None:
+        key = generate_private_key(key_type, key_size)
 
     subject = x509.Name(
         [
@@ -107,27 +173,72 @@ def generate_key_and_csr(
         x509.CertificateSigningRequestBuilder()
         .subject_name(subject)
         .add_extension(extensions, critical=False)
-        .sign(key, hashes.SHA256(), default_backend())
+        .sign(key, _signature_hash(key), default_backend())
     )
 
     if directory:
         with open(f"{directory}/server-key.pem", "wb") as f:
-            f.write(
-                key.private_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PrivateFormat.TraditionalOpenSSL,
-                    encryption_algorithm=serialization.NoEncryption(),
-                )
-            )
+            f.write(_private_key_pem(key))
         with open(f"{directory}/server-csr.pem", "wb") as f:
             f.write(csr.public_bytes(encoding=serialization.Encoding.PEM))
 
     return key, csr
 
 
+@dataclass(frozen=True)
+class Issuer:
+    """A parsed issuer key and certificate."""
+
+    key: PrivateKey
+    cert: Certificate
+
+
+# (key path, cert path) -> (the stat of both files when loaded, the issuer)
+_issuers: Dict[Tuple[str, str], Tuple[Tuple, Issuer]] = {}
+_issuers_lock = threading.Lock()
+
+
+def _file_version(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_issuer(issuer_key_path: str, issuer_cert_path: str) -> Issuer:
+    """Load the issuer key and certificate, parsed once and cached.
+
+    The files are read and parsed again only when their modification time or size
+    changes, e.g. when the CA is renewed.
+
+    Args:
+        issuer_key_path (str): the issuer private key path.
+        issuer_cert_path (str): the issuer certificate path.
+
+    Returns:
+        Issuer: returns the issuer key and certificate.
+    """
+    paths = (issuer_key_path, issuer_cert_path)
+    version = (_file_version(issuer_key_path), _file_version(issuer_cert_path))
+    cached = _issuers.get(paths)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _issuers_lock:
+        cached = _issuers.get(paths)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with open(issuer_key_path, "rb") as key_file:
+            key = serialization.load_pem_private_key(
+                key_file.read(), password=None, backend=default_backend()
+            )
+        with open(issuer_cert_path, "rb") as cert_file:
+            cert = x509.load_pem_x509_certificate(cert_file.read(), default_backend())
+        issuer = Issuer(key=key, cert=cert)  # type: ignore
+        _issuers[paths] = (version, issuer)
+        return issuer
+
+
 def sign_certificate(
     csr: CertificateSigningRequest,
-    issuer_key: Optional[rsa.RSAPrivateKey] = None,
+    issuer_key: Optional[PrivateKey] = None,
     issuer_key_path: Optional[str] = None,
     issuer_cert: Optional[Certificate] = None,
     issuer_cert_path: Optional[str] = None,
@@ -136,9 +247,12 @@ def sign_certificate(
 ) -> Certificate:
     """Sign the certifcate signing request
 
+    Issuer files are loaded through `load_issuer`, so they are only parsed again when
+    they change.
+
     Args:
         csr (CertificateSigningRequest): the certificate signing request.
-        issuer_key (Optional[rsa.RSAPrivateKey]): the issuer private key.
+        issuer_key (Optional[PrivateKey]): the issuer private key.
         issuer_key_path (Optional[str]): the issuer private key path.
         issuer_cert (Optional[Certificate]): the issuer certificate.
         issuer_cert_path (Optional[str]): the issuer certificate path.
@@ -162,10 +276,7 @@ def sign_certificate(
     if issuer_key and issuer_key_path is None:
         _issuer_key = issuer_key
     elif issuer_key_path and issuer_key is None:
-        with open(issuer_key_path, "rb") as key_file:
-            _issuer_key = serialization.load_pem_private_key(
-                key_file.read(), password=None, backend=default_backend()
-            )
+        _issuer_key = None
     else:
         raise IssuerKeyNotDefined(
             "Either issuer_key or issuer_key_path must be provided.")
@@ -173,22 +284,50 @@ def sign_certificate(
     if issuer_cert and issuer_cert_path is None:
         _issuer_cert = issuer_cert
     elif issuer_cert_path and issuer_cert is None:
-        with open(issuer_cert_path, "rb") as cert_file:
-            _issuer_cert = x509.load_pem_x509_certificate(
-                cert_file.read(), default_backend()
-            )
+        _issuer_cert = None
     else:
         raise IssuerCertNotDefined(
             "Either issuer_cert or issuer_cert_path must be provided.")
 
-    cert = (
+    if _issuer_key is None or _issuer_cert is None:
+        if issuer_key_path and issuer_cert_path:
+            issuer = load_issuer(issuer_key_path, issuer_cert_path)
+            _issuer_key = _issuer_key or issuer.key
+            _issuer_cert = _issuer_cert or issuer.cert
+        elif issuer_key_path:
+            with open(issuer_key_path, "rb") as key_file:
+                _issuer_key = serialization.load_pem_private_key(
+                    key_file.read(), password=None, backend=default_backend()
+                )
+        else:
+            with open(issuer_cert_path, "rb") as cert_file:  # type: ignore
+                _issuer_cert = x509.load_pem_x509_certificate(
+                    cert_file.read(), default_backend()
+                )
+
+    cert = _sign(csr, _issuer_key, _issuer_cert, validity_days)  # type: ignore
+
+    if directory:
+        with open(f"{directory}/server-cert.pem", "wb") as f:
+            f.write(cert.public_bytes(encoding=serialization.Encoding.PEM))
+    return cert
+
+
+def _sign(
+    csr: CertificateSigningRequest,
+    issuer_key: PrivateKey,
+    issuer_cert: Certificate,
+    validity_days: int,
+) -> Certificate:
+    now = datetime.now(timezone.utc)
+    return (
         x509.CertificateBuilder()
         .subject_name(csr.subject)
-        .issuer_name(_issuer_cert.subject)
+        .issuer_name(issuer_cert.subject)
         .public_key(csr.public_key())
         .serial_number(x509.random_serial_number())
-        .not_valid_before(datetime.now(timezone.utc))
-        .not_valid_after(datetime.now(timezone.utc) + timedelta(days=validity_days))
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=validity_days))
         .add_extension(
             x509.BasicConstraints(ca=False, path_length=None),
             critical=True,
@@ -198,10 +337,204 @@ def sign_certificate(
                 x509.SubjectAlternativeName).value,
             critical=False,
         )
-        .sign(_issuer_key, hashes.SHA256(), default_backend())  # type: ignore
+        .sign(issuer_key, _signature_hash(issuer_key), default_backend())  # type: ignore
     )
 
-    if directory:
-        with open(f"{directory}/server-cert.pem", "wb") as f:
-            f.write(cert.public_bytes(encoding=serialization.Encoding.PEM))
-    return cert
+
+def _sign_pem_batch(
+    issuer_key_path: str,
+    issuer_cert_path: str,
+    csr_pems: Sequence[bytes],
+    validity_days: int,
+) -> List[bytes]:
+    # PEM in and out so a batch crosses a process boundary cheaply, each worker
+    # process keeps its own cached issuer
+    issuer = load_issuer(issuer_key_path, issuer_cert_path)
+    return [
+        _sign(
+            x509.load_pem_x509_csr(csr_pem, default_backend()),
+            issuer.key,
+            issuer.cert,
+            validity_days,
+        ).public_bytes(serialization.Encoding.PEM)
+        for csr_pem in csr_pems
+    ]
+
+
+def _generate_key_and_csr_pem(
+    common_name: str,
+    san_dns_names: List[str],
+    san_uris: Optional[List[str]],
+    key_type: str,
+    key_size: Optional[int],
+) -> Tuple[bytes, bytes]:
+    key, csr = generate_key_and_csr(
+        common_name, san_dns_names, san_uris, key_type=key_type, key_size=key_size
+    )
+    return _private_key_pem(key), csr.public_bytes(serialization.Encoding.PEM)
+
+
+class CertificateService:
+    """Issues certificates from a CA on disk without blocking the event loop.
+
+    Key generation and signing run on a worker pool, threads by default or processes
+    for RSA keys, which hold the GIL for most of their generation. The issuer is parsed
+    once per worker and reloaded when its files change. Batches are split into one
+    chunk per worker, so bulk issuance keeps every worker busy while paying the pool
+    round trip once per chunk instead of once per certificate. With a key pool, keys
+    are taken from it instead of being generated, and its key type applies.
+    """
+
+    def __init__(
+        self,
+        issuer_key_path: str,
+        issuer_cert_path: str,
+        workers: Optional[int] = None,
+        executor: str = "thread",
+        key_type: str = "ec",
+        key_size: Optional[int] = None,
+        validity_days: int = 365,
+        key_pool: Optional["KeyPool"] = None,
+    ):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unsupported executor {executor}.")
+        self.issuer_key_path = issuer_key_path
+        self.issuer_cert_path = issuer_cert_path
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.executor = executor
+        self.key_type = key_type
+        self.key_size = key_size
+        self.validity_days = validity_days
+        self.key_pool = key_pool
+        self._pool: Optional[Executor] = None
+
+    @property
+    def issuer(self) -> Issuer:
+        """The issuer key and certificate, reloaded if the files changed."""
+        return load_issuer(self.issuer_key_path, self.issuer_cert_path)
+
+    async def generate_key_and_csr(
+        self,
+        common_name: str,
+        san_dns_names: List[str],
+        san_uris: Optional[List[str]] = None,
+    ) -> Tuple[PrivateKey, CertificateSigningRequest]:
+        """Generates a private key of the service key type and a CSR on the pool.
+
+        With a key pool, the key is taken from it and only the CSR is built, in place.
+        """
+        if self.key_pool is not None:
+            key = await self.key_pool.get()
+            return generate_key_and_csr(common_name, san_dns_names, san_uris, key=key)
+        key_pem, csr_pem = await self._run(
+            _generate_key_and_csr_pem,
+            common_name,
+            san_dns_names,
+            san_uris,
+            self.key_type,
+            self.key_size,
+        )
+        # the key was just generated, validating it again costs ~50ms per RSA key
+        key = serialization.load_pem_private_key(
+            key_pem, password=None, unsafe_skip_rsa_key_validation=True
+        )
+        return key, x509.load_pem_x509_csr(csr_pem, default_backend())  # type: ignore
+
+    async def sign(
+        self, csr: CertificateSigningRequest, validity_days: Optional[int] = None
+    ) -> Certificate:
+        """Signs the CSR on the pool."""
+        return (await self.sign_many([csr], validity_days))[0]
+
+    async def sign_many(
+        self,
+        csrs: Sequence[CertificateSigningRequest],
+        validity_days: Optional[int] = None,
+    ) -> List[Certificate]:
+        """Signs the CSRs in parallel chunks on the pool, in order.
+
+        Args:
+            csrs (Sequence[CertificateSigningRequest]): the certificate signing requests.
+            validity_days (Optional[int], optional): the number of days before expiration. Defaults to the service validity.
+
+        Returns:
+            List[Certificate]: returns the signed certificates.
+        """
+        if not csrs:
+            return []
+        validity_days = validity_days or self.validity_days
+        csr_pems = [csr.public_bytes(serialization.Encoding.PEM) for csr in csrs]
+        chunk_size = -(-len(csr_pems) // self.workers)
+        chunks = await asyncio.gather(
+            *[
+                self._run(
+                    _sign_pem_batch,
+                    self.issuer_key_path,
+                    self.issuer_cert_path,
+                    csr_pems[i : i + chunk_size],
+                    validity_days,
+                )
+                for i in range(0, len(csr_pems), chunk_size)
+            ]
+        )
+        return [
+            x509.load_pem_x509_certificate(cert_pem, default_backend())
+            for chunk in chunks
+            for cert_pem in chunk
+        ]
+
+    async def issue(
+        self,
+        common_name: str,
+        san_dns_names: List[str],
+        san_uris: Optional[List[str]] = None,
+        validity_days: Optional[int] = None,
+    ) -> Tuple[PrivateKey, Certificate]:
+        """Generates a key and a CSR and signs it, returning the key and certificate."""
+        key, csr = await self.generate_key_and_csr(common_name, san_dns_names, san_uris)
+        return key, await self.sign(csr, validity_days)
+
+    async def issue_many(
+        self,
+        subjects: Sequence[Tuple[str, List[str]]],
+        validity_days: Optional[int] = None,
+    ) -> List[Tuple[PrivateKey, Certificate]]:
+        """Issues a key and certificate for every (common name, DNS names) pair.
+
+        Args:
+            subjects (Sequence[Tuple[str, List[str]]]): the common name and subject alternative names of each certificate.
+            validity_days (Optional[int], optional): the number of days before expiration. Defaults to the service validity.
+
+        Returns:
+            List[Tuple[PrivateKey, Certificate]]: returns the keys and certificates, in order.
+        """
+        keys_and_csrs = await asyncio.gather(
+            *[
+                self.generate_key_and_csr(common_name, san_dns_names)
+                for common_name, san_dns_names in subjects
+            ]
+        )
+        certs = await self.sign_many([csr for _, csr in keys_and_csrs], validity_days)
+        return [(key, cert) for (key, _), cert in zip(keys_and_csrs, certs)]
+
+    def reset(self):
+        """Forgets the worker pool without shutting it down, e.g. in a forked child."""
+        self._pool = None
+
+    def shutdown(self):
+        """Shuts the worker pool down."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    async def _run(self, fn, *args):
+        if self._pool is None:
+            self._pool = (
+                ProcessPoolExecutor(max_workers=self.workers)
+                if self.executor == "process"
+                else ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="FasterAPI-cert"
+                )
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, fn, *args)
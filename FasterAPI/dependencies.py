@@ -1,22 +1,37 @@
 from datetime import datetime
+from time import perf_counter
 from typing import Annotated
 
-from fastapi import Depends, HTTPException, Request, status
+from fastapi import Depends, HTTPException, status
 from fastapi.security import SecurityScopes
-from jose import JWTError, jwt
+from jose import JWTError
 from sqlalchemy.orm import Session
 
-from .essentials import ALGORITHM, ALLOW_MULTI_SESSIONS, SECRET_KEY, get_db, oauth2_scheme
-from .models import ActiveSession, BlacklistedToken, User
+from .cache import CachedToken, session_digest, token_cache, token_digest
+from .essentials import STATELESS_TOKENS, AnySession, get_db, oauth2_scheme, run_db
+from .keyring import decode_token
+from .metrics import AUTH_CACHE, AUTH_DB, AUTH_JWT
+from .models import User
+from .replica import replica_router
+from .revocation import revocation_index
+from .store import session_store
 
 
 async def authenticated(
-    request: Request,
     security_scopes: SecurityScopes,
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AnySession, Depends(get_db)],
 ):
-    """A dependency function to authenticate the user."""
+    """A dependency function to authenticate the user.
+
+    Every token belongs to the session named by its sid claim, which must still be
+    active. Verified tokens are cached in memory until they expire or their session is
+    revoked, so repeated requests with the same token skip the database. With STATELESS_TOKENS enabled, privileges, the
+    superuser flag and the client binding are read from the token claims instead of the
+    database. In both cases the returned user is a detached snapshot. With read
+    replicas configured the user and session are read from a replica, unless this
+    worker changed the user moments ago.
+    """
 
     if security_scopes.scopes:
         authenticate_value = f'Bearer scope="{security_scopes.scope_str}"'
@@ -28,9 +43,9 @@ async def authenticated(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": authenticate_value},
     )
-    multi_session_exception = HTTPException(
+    session_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Multiple sessions are not allowed",
+        detail="Session has expired or been revoked",
         headers={"WWW-Authenticate": authenticate_value},
     )
     scope_exception = HTTPException(
@@ -48,31 +63,105 @@ async def authenticated(
         detail="JWT token has expired",
         headers={"WWW-Authenticate": authenticate_value},
     )
-    blacklisted_token = (
-        db.query(BlacklistedToken).filter(BlacklistedToken.token == token).first()
-    )
-    if blacklisted_token:
-        raise jwt_exception
+    start = perf_counter()
+    cached = token_cache.get(token)
+    AUTH_CACHE.observe(perf_counter() - start)
+    if cached is not None:
+        if not set(security_scopes.scopes).issubset(cached.privileges):
+            raise scope_exception
+        return cached.to_user()
+
+    if revocation_index.might_contain(token):
+        start = perf_counter()
+        blacklisted = await session_store.is_revoked(db, token_digest(token))
+        AUTH_DB.observe(perf_counter() - start)
+        if blacklisted:
+            raise jwt_exception
+    start = perf_counter()
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username: str = payload["sub"]
         expiration = datetime.fromtimestamp(payload["exp"])
     except JWTError:
         raise jwt_exception
+    finally:
+        AUTH_JWT.observe(perf_counter() - start)
     if expiration < datetime.now():
         raise jwt_expired_exception
-    user = db.query(User).filter(User.username == username).first()
+    sid = payload.get("sid")
+    if sid is None:
+        raise session_exception
+    stateless = STATELESS_TOKENS and "scopes" in payload
+    # sessions are revoked through the revocation index rather than looked up, or the
+    # session may still be on a lagging replica
+    if (stateless or replica_router.enabled) and revocation_index.might_contain_digest(
+        bytes.fromhex(session_digest(sid))
+    ):
+        start = perf_counter()
+        revoked = await session_store.is_revoked(db, session_digest(sid))
+        AUTH_DB.observe(perf_counter() - start)
+        if revoked:
+            raise session_exception
+    if stateless:
+        entry = CachedToken(
+            claims=payload,
+            exp=payload["exp"],
+            user_id=payload["uid"],
+            username=username,
+            first_name=payload["given_name"],
+            last_name=payload["family_name"],
+            email=payload["email"],
+            is_superuser=payload["su"],
+            privileges=frozenset(payload["scopes"]),
+            session=session_digest(sid),
+        )
+        if not set(security_scopes.scopes).issubset(entry.privileges):
+            raise scope_exception
+        token_cache.put(token, entry)
+        return entry.to_user()
+
+    def _load_user(db: Session):
+        user = db.query(User).filter(User.username == username).first()
+        if user is None:
+            return None, []
+        user_privileges = [privilege.privilege for privilege in user.privileges]
+        return user, user_privileges
+
+    async def _load_user_and_session(db: AnySession):
+        user, user_privileges = await run_db(db, _load_user)
+        session = None
+        if user is not None:
+            session = await session_store.get_session(db, sid)
+        return user, user_privileges, session
+
+    start = perf_counter()
+    # a login moments ago may not have reached the replica yet, so misses are read
+    # again from the primary
+    user, user_privileges, session = await replica_router.read(
+        db, _load_user_and_session, username, retry=lambda result: result[2] is None
+    )
+    AUTH_DB.observe(perf_counter() - start)
     if user is None:
         raise credentials_exception
-    user_privileges = [privilege.privilege for privilege in user.privileges]
+    if session is None or session.username != username:
+        raise session_exception
     if not set(security_scopes.scopes).issubset(set(user_privileges)):
         raise scope_exception
-    active_session = (
-        db.query(ActiveSession).filter(ActiveSession.username == username).first()
+    token_cache.put(
+        token,
+        CachedToken(
+            claims=payload,
+            exp=payload["exp"],
+            user_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            email=user.email,
+            is_superuser=user.is_superuser,
+            privileges=frozenset(user_privileges),
+            session=session_digest(sid),
+        ),
     )
-    if ALLOW_MULTI_SESSIONS is False:
-        if request.client.host != str(active_session.client):  # type: ignore
-            raise multi_session_exception
     return user
 
 
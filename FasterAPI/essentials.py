@@ -1,70 +1,250 @@
 from __future__ import annotations
 
 import os
-import secrets
-from typing import Dict
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Union
 
-import yaml
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.orm import Session, sessionmaker
 
 from . import logger
+from .metrics import InstrumentedAsyncQueuePool, InstrumentedQueuePool, register_pool_metrics
+from .settings import get_settings
 
-try:
-    config: Dict = yaml.safe_load(open("./auth_config.yaml", "r"))
-    logger.warning(
-        "Configuration file auth_config.yaml not found. Default values will be used."
-    )
-except FileNotFoundError:
-    config = {}
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+settings = get_settings()
+# the raw configuration, including keys only the application knows
+config: Dict = settings.model_dump()
+meta_config = config
+
+# set up database
+SQLALCHEMY_DATABASE_URL = settings.SQLALCHEMY_DATABASE_URL
+
+# requires sqlalchemy[asyncio] and an async driver, e.g. "postgresql+asyncpg://"
+ASYNC_DATABASE = settings.ASYNC_DATABASE
 
-try:
-    meta_config: Dict = yaml.safe_load(open("./meta_config.yaml", "r"))
-    logger.warning(
-        "Configuration file meta_config.yaml not found. Default values will be used."
+POOL_SIZE = settings.POOL_SIZE
+MAX_OVERFLOW = settings.MAX_OVERFLOW
+POOL_TIMEOUT = settings.POOL_TIMEOUT
+POOL_RECYCLE = settings.POOL_RECYCLE
+POOL_PRE_PING = settings.POOL_PRE_PING
+
+
+def _engine_options(url: str) -> Dict:
+    """Returns the connection pool options for the engine of the url."""
+    options: Dict = {"pool_pre_ping": POOL_PRE_PING}
+    if POOL_RECYCLE is not None:
+        options["pool_recycle"] = int(POOL_RECYCLE)
+    parsed_url = make_url(url)
+    if parsed_url.get_backend_name() == "sqlite" and parsed_url.database in (
+        None,
+        "",
+        ":memory:",
+    ):
+        # in-memory SQLite keeps a single connection, there is no pool to tune
+        return options
+    options["poolclass"] = (
+        InstrumentedAsyncQueuePool if ASYNC_DATABASE else InstrumentedQueuePool
     )
-except FileNotFoundError:
-    meta_config = {}
+    if POOL_SIZE is not None:
+        options["pool_size"] = int(POOL_SIZE)
+    if MAX_OVERFLOW is not None:
+        options["max_overflow"] = int(MAX_OVERFLOW)
+    if POOL_TIMEOUT is not None:
+        options["pool_timeout"] = float(POOL_TIMEOUT)
+    return options
 
 
-# set up database
-SQLALCHEMY_DATABASE_URL = os.getenv(
-    "SQLALCHEMY_DATABASE_URL", config.get("SQLALCHEMY_DATABASE_URL", "sqlite:///dev.db")
-)
+def open_engine(url: str):
+    """Returns the engine and the session factory of the database url."""
+    if ASYNC_DATABASE:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
-if SQLALCHEMY_DATABASE_URL is None:
-    raise Exception("SQLALCHEMY_DATABASE_URL is not set.")
+        engine = create_async_engine(url, **_engine_options(url))
+        return engine, async_sessionmaker(autoflush=False, bind=engine)
+    engine = create_engine(url, **_engine_options(url))
+    return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=Engine)
 
+Engine, SessionLocal = open_engine(SQLALCHEMY_DATABASE_URL)
+register_pool_metrics(lambda: getattr(Engine, "sync_engine", Engine).pool)
 
-def get_db():
-    global Engine
-    global SessionLocal
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
 
+def _reset_pool_after_fork():
+    # connections opened before a fork must not be shared with the child
+    getattr(Engine, "sync_engine", Engine).dispose(close=False)
 
-SECRET_KEY = os.getenv("SECRET_KEY", config.get("SECRET_KEY", secrets.token_hex(32)))
-ALGORITHM = os.getenv("ALGORITHM", config.get("ALGORITHM", "HS256"))
-TOKEN_URL = os.getenv("TOKEN_URL", config.get("TOKEN_URL", "login"))
-TOKEN_EXPIRATION_TIME = int(
-    os.getenv(
-        "TOKEN_EXPIRATION_TIME",
-        config.get("TOKEN_EXPIRATION_TIME", 15),
-    )
-)
-ALLOW_MULTI_SESSIONS = os.getenv(
-    "ALLOW_MULTI_SESSIONS", config.get("ALLOW_MULTI_SESSIONS", True)
-)
-ALLOW_SELF_REGISTRATION = os.getenv(
-    "ALLOW_SELF_REGISTRATION", config.get("ALLOW_SELF_REGISTRATION", False)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+AnySession = Union[Session, "AsyncSession"]
+
+if ASYNC_DATABASE:
+
+    async def get_db():
+        async with SessionLocal() as db:
+            yield db
+
+else:
+
+    def get_db():
+        global Engine
+        global SessionLocal
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+@asynccontextmanager
+async def open_db():
+    """Opens a database session outside of a request, e.g. in background tasks."""
+    if ASYNC_DATABASE:
+        async with SessionLocal() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+async def run_db(db: AnySession, fn: Callable[..., Any], *args) -> Any:
+    """Runs fn(session, *args) against the database.
+
+    With an async engine the call goes through AsyncSession.run_sync, so the queries
+    do not block the event loop. Otherwise it runs inline on the sync session.
+    """
+    if ASYNC_DATABASE:
+        return await db.run_sync(fn, *args)  # type: ignore
+    return fn(db, *args)
+
+
+async def run_ddl(fn: Callable[..., Any]):
+    """Runs fn(connection) in a transaction, e.g. to create or migrate tables."""
+    if ASYNC_DATABASE:
+        async with Engine.begin() as conn:  # type: ignore
+            await conn.run_sync(fn)
+    else:
+        with Engine.begin() as conn:  # type: ignore
+            fn(conn)
+
+
+async def init_db(metadata):
+    """Creates all tables of the metadata."""
+    await run_ddl(metadata.create_all)
+
+
+SECRET_KEY = settings.SECRET_KEY
+ALGORITHM = settings.ALGORITHM
+# only used with asymmetric algorithms (RS256, ES256, ...)
+KEY_DIRECTORY = settings.KEY_DIRECTORY
+KEY_ROTATION_INTERVAL = settings.KEY_ROTATION_INTERVAL
+METRICS = settings.METRICS
+METRICS_URL = settings.METRICS_URL
+TOKEN_URL = settings.TOKEN_URL
+TOKEN_EXPIRATION_TIME = settings.TOKEN_EXPIRATION_TIME
+ALLOW_MULTI_SESSIONS = settings.ALLOW_MULTI_SESSIONS
+REFRESH_TOKEN_EXPIRATION_TIME = settings.REFRESH_TOKEN_EXPIRATION_TIME
+MAX_SESSIONS_PER_USER = settings.MAX_SESSIONS_PER_USER
+ALLOW_SELF_REGISTRATION = settings.ALLOW_SELF_REGISTRATION
+STATELESS_TOKENS = settings.STATELESS_TOKENS
+REVOCATION_INDEX = settings.REVOCATION_INDEX
+REVOCATION_INDEX_CAPACITY = settings.REVOCATION_INDEX_CAPACITY
+REVOCATION_SYNC_INTERVAL = settings.REVOCATION_SYNC_INTERVAL
+SESSION_STORE = settings.SESSION_STORE
+SESSION_STORE_URL = settings.SESSION_STORE_URL
+SESSION_STORE_POOL_SIZE = settings.SESSION_STORE_POOL_SIZE
+SESSION_STORE_PREFIX = settings.SESSION_STORE_PREFIX
+READ_REPLICA_URLS = settings.READ_REPLICA_URLS
+REPLICA_MAX_LAG = settings.REPLICA_MAX_LAG
+REPLICA_CHECK_INTERVAL = settings.REPLICA_CHECK_INTERVAL
+READ_YOUR_WRITES_WINDOW = settings.READ_YOUR_WRITES_WINDOW
+LOGIN_RATE_LIMIT_PER_IP = settings.LOGIN_RATE_LIMIT_PER_IP
+LOGIN_RATE_LIMIT_PER_USERNAME = settings.LOGIN_RATE_LIMIT_PER_USERNAME
+LOGIN_RATE_LIMIT_PERIOD = settings.LOGIN_RATE_LIMIT_PERIOD
+RATE_LIMIT_BACKEND = settings.RATE_LIMIT_BACKEND
+RATE_LIMIT_URL = settings.rate_limit_url
+REAPER_INTERVAL = settings.reaper_interval
+REAPER_JITTER = settings.REAPER_JITTER
+REAPER_BATCH_SIZE = settings.REAPER_BATCH_SIZE
+SEED_FILE = settings.SEED_FILE
+SEED_CHUNK_SIZE = settings.SEED_CHUNK_SIZE
+TOKEN_CACHE_SIZE = settings.TOKEN_CACHE_SIZE
+USERNAME_CACHE_SIZE = settings.USERNAME_CACHE_SIZE
+USERNAME_CACHE_TTL = settings.USERNAME_CACHE_TTL
+HASH_EXECUTOR = settings.HASH_EXECUTOR
+HASH_WORKERS = settings.HASH_WORKERS
+HASH_QUEUE_SIZE = settings.HASH_QUEUE_SIZE
+# argon2 requires argon2-cffi
+PASSWORD_SCHEMES = settings.PASSWORD_SCHEMES
+BCRYPT_ROUNDS = settings.BCRYPT_ROUNDS
+ARGON2_TIME_COST = settings.ARGON2_TIME_COST
+ARGON2_MEMORY_COST = settings.ARGON2_MEMORY_COST
+ARGON2_PARALLELISM = settings.ARGON2_PARALLELISM
+KEY_POOL_SIZE = settings.KEY_POOL_SIZE
+KEY_POOL_KEY_TYPE = settings.KEY_POOL_KEY_TYPE
+KEY_POOL_KEY_SIZE = settings.KEY_POOL_KEY_SIZE
+KEY_POOL_WORKERS = settings.KEY_POOL_WORKERS
+KEY_POOL_EXECUTOR = settings.KEY_POOL_EXECUTOR
+KEY_POOL_SPILL_DIRECTORY = settings.KEY_POOL_SPILL_DIRECTORY
+KEY_POOL_SPILL_SIZE = settings.KEY_POOL_SPILL_SIZE
+KEY_POOL_SPILL_PASSPHRASE = settings.KEY_POOL_SPILL_PASSPHRASE
+
+
+def make_crypt_context(
+    schemes: List[str],
+    bcrypt_rounds: int = 12,
+    argon2_time_cost: int = 2,
+    argon2_memory_cost: int = 102400,
+    argon2_parallelism: int = 8,
+) -> CryptContext:
+    """Returns a password context hashing with the first scheme at the given cost.
+
+    Hashes of the other schemes, or made at a different cost, still verify but are
+    reported as outdated by verify_and_update, so they are rehashed on login.
+
+    Args:
+        schemes (List[str]): the passlib schemes, e.g. ["argon2", "bcrypt"].
+        bcrypt_rounds (int, optional): the bcrypt log2 cost. Defaults to 12.
+        argon2_time_cost (int, optional): the argon2 iterations. Defaults to 2.
+        argon2_memory_cost (int, optional): the argon2 memory in KiB. Defaults to 102400.
+        argon2_parallelism (int, optional): the argon2 lanes. Defaults to 8.
+
+    Returns:
+        CryptContext: returns the password context.
+    """
+    options: Dict[str, Any] = {}
+    if "bcrypt" in schemes:
+        options.update(
+            bcrypt__rounds=bcrypt_rounds,
+            bcrypt__min_rounds=bcrypt_rounds,
+            bcrypt__max_rounds=bcrypt_rounds,
+        )
+    if "argon2" in schemes:
+        options.update(
+            argon2__type="ID",
+            argon2__rounds=argon2_time_cost,
+            argon2__min_rounds=argon2_time_cost,
+            argon2__max_rounds=argon2_time_cost,
+            argon2__memory_cost=argon2_memory_cost,
+            argon2__parallelism=argon2_parallelism,
+        )
+    return CryptContext(schemes=schemes, deprecated="auto", **options)
+
+
+pwd_context = make_crypt_context(
+    PASSWORD_SCHEMES,
+    bcrypt_rounds=BCRYPT_ROUNDS,
+    argon2_time_cost=ARGON2_TIME_COST,
+    argon2_memory_cost=ARGON2_MEMORY_COST,
+    argon2_parallelism=ARGON2_PARALLELISM,
 )
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=TOKEN_URL)
@@ -0,0 +1,149 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from .essentials import HASH_EXECUTOR, HASH_QUEUE_SIZE, HASH_WORKERS, pwd_context
+from .metrics import PASSWORD_HASH, PASSWORD_VERIFY, Counter, Gauge, registry
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(password, hashed_password)
+
+
+def _verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+class PasswordHasher:
+    """Runs password hashing and verification on a bounded worker pool.
+
+    At most `workers` hashes run at once and at most `queue_size` more may wait for a
+    worker. Any call beyond that is rejected with 503, so a login burst cannot pile
+    up unbounded work or stall the event loop.
+    """
+
+    def __init__(self, workers: int, queue_size: int, executor: str = "thread"):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = executor
+        self.rejected = 0
+        self._pending = 0
+        self._pool: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def pending(self) -> int:
+        """The number of hashes running or waiting for a worker."""
+        return self._pending
+
+    async def hash(self, password: str) -> str:
+        """Hashes the password."""
+        start = perf_counter()
+        hashed_password = await self._run(_hash, password)
+        PASSWORD_HASH.observe(perf_counter() - start)
+        return hashed_password
+
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        """Hashes the passwords in parallel on the pool.
+
+        Meant for bulk provisioning: the batch is submitted `workers` at a time and waits
+        for free workers instead of being rejected, so it never fills the queue that
+        logins rely on.
+        """
+        start = perf_counter()
+        hashed_passwords: List[str] = []
+        for i in range(0, len(passwords), self.workers):
+            hashed_passwords.extend(
+                await asyncio.gather(
+                    *[
+                        self._run(_hash, password, reject=False)
+                        for password in passwords[i : i + self.workers]
+                    ]
+                )
+            )
+        if passwords:
+            PASSWORD_HASH.observe((perf_counter() - start) / len(passwords))
+        return hashed_passwords
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        """Verifies the password against the hash."""
+        start = perf_counter()
+        verified = await self._run(_verify, password, hashed_password)
+        PASSWORD_VERIFY.observe(perf_counter() - start)
+        return verified
+
+    async def verify_and_update(
+        self, password: str, hashed_password: str
+    ) -> Tuple[bool, Optional[str]]:
+        """Verifies the password, also returning a new hash if the old one is outdated."""
+        start = perf_counter()
+        verified, new_hash = await self._run(_verify_and_update, password, hashed_password)
+        PASSWORD_VERIFY.observe(perf_counter() - start)
+        return verified, new_hash
+
+    def reset(self):
+        """Forgets the worker pool without shutting it down, e.g. in a forked child."""
+        self._pool = None
+        self._semaphore = None
+        self._pending = 0
+
+    def shutdown(self):
+        """Shuts the worker pool down."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        self._semaphore = None
+
+    async def _run(self, fn, *args, reject: bool = True):
+        if reject and self._pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please retry later",
+                headers={"Retry-After": "1"},
+            )
+        if self._pool is None:
+            self._pool = (
+                ProcessPoolExecutor(max_workers=self.workers)
+                if self.executor == "process"
+                else ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="FasterAPI-hash"
+                )
+            )
+            self._semaphore = asyncio.Semaphore(self.workers)
+        self._pending += 1
+        try:
+            async with self._semaphore:  # type: ignore
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._pool, fn, *args)
+        finally:
+            self._pending -= 1
+
+
+password_hasher = PasswordHasher(HASH_WORKERS, HASH_QUEUE_SIZE, HASH_EXECUTOR)
+if hasattr(os, "register_at_fork"):
+    # the pool threads of the parent do not exist in a forked child
+    os.register_at_fork(after_in_child=password_hasher.reset)
+
+registry.register(
+    Counter(
+        "fasterapi_password_hash_rejected_total",
+        "Password hashes rejected because the worker pool queue was full.",
+        callback=lambda: password_hasher.rejected,
+    )
+)
+registry.register(
+    Gauge(
+        "fasterapi_password_hash_pending",
+        "Password hashes running or waiting for a worker.",
+        callback=lambda: password_hasher.pending,
+    )
+)
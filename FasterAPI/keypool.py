@@ -0,0 +1,293 @@
+import asyncio
+import os
+import uuid
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+from typing import Deque, List, Optional, Union
+
+from cryptography.hazmat.primitives import serialization
+
+from . import logger
+from .cert import PrivateKey, _private_key_pem, generate_private_key
+from .essentials import (
+    KEY_POOL_EXECUTOR,
+    KEY_POOL_KEY_SIZE,
+    KEY_POOL_KEY_TYPE,
+    KEY_POOL_SIZE,
+    KEY_POOL_SPILL_DIRECTORY,
+    KEY_POOL_SPILL_PASSPHRASE,
+    KEY_POOL_SPILL_SIZE,
+    KEY_POOL_WORKERS,
+)
+from .metrics import (
+    KEY_GENERATION,
+    KEY_POOL_REFILLS_DISK,
+    KEY_POOL_REFILLS_MEMORY,
+    KEY_POOL_TAKEN_DISK,
+    KEY_POOL_TAKEN_GENERATED,
+    KEY_POOL_TAKEN_MEMORY,
+    Gauge,
+    registry,
+)
+
+
+def _generate(
+    key_type: str, key_size: Optional[int], pem: bool
+) -> Union[PrivateKey, bytes]:
+    # process workers hand the key back as PEM, key objects do not pickle
+    key = generate_private_key(key_type, key_size)
+    return _private_key_pem(key) if pem else key
+
+
+def _load_key(data: bytes, password: Optional[bytes] = None) -> PrivateKey:
+    # the keys were generated by this pool, validating them again costs ~50ms per RSA key
+    return serialization.load_pem_private_key(
+        data, password=password, unsafe_skip_rsa_key_validation=True
+    )  # type: ignore
+
+
+class KeyPool:
+    """Keeps pre-generated private keys warm so issuance does not wait for key generation.
+
+    A background task tops the pool up to `size` keys, generating `workers` keys at a
+    time on a thread or process pool. Only `size` keys are held in memory. With a spill
+    directory, the refill keeps generating once the pool is full until `spill_size`
+    more keys wait on disk, each encrypted with the passphrase, and the pool is refilled
+    from them first, so a burst larger than the pool, or a restart, does not fall back to
+    generating keys on demand. Every key is handed out once: a spilled key is claimed by
+    renaming its file, so workers can share the directory, and it is deleted once read.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        key_type: str = "rsa",
+        key_size: Optional[int] = None,
+        workers: int = 2,
+        executor: str = "thread",
+        spill_directory: Optional[str] = None,
+        spill_size: int = 1000,
+        spill_passphrase: Optional[str] = None,
+    ):
+        if spill_directory and not spill_passphrase:
+            raise ValueError("A spill passphrase is required to spill keys to disk.")
+        self.size = size
+        self.key_type = key_type
+        self.key_size = key_size
+        self.workers = workers
+        self.executor = executor
+        self.spill_directory = spill_directory
+        self.spill_size = spill_size if spill_directory else 0
+        self._passphrase = spill_passphrase.encode() if spill_passphrase else None
+        self._keys: Deque[PrivateKey] = deque()
+        self._spilled = 0
+        self._pool: Optional[Executor] = None
+        self._refill: Optional[asyncio.Task] = None
+        self._wanted: Optional[asyncio.Event] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    @property
+    def depth(self) -> int:
+        """The number of keys waiting in memory."""
+        return len(self._keys)
+
+    @property
+    def spilled(self) -> int:
+        """The number of keys waiting on disk, as last counted."""
+        return self._spilled
+
+    async def start(self):
+        """Starts refilling the pool in the background."""
+        if self._refill is not None:
+            return
+        if self.spill_directory:
+            os.makedirs(self.spill_directory, mode=0o700, exist_ok=True)
+        self._wanted = asyncio.Event()
+        self._refill = asyncio.create_task(self._run_refill())
+
+    async def stop(self):
+        """Stops the refill and shuts the worker pool down, spilled keys are kept."""
+        if self._refill is not None:
+            self._refill.cancel()
+            try:
+                await self._refill
+            except asyncio.CancelledError:
+                pass
+            self._refill = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def reset(self):
+        """Forgets the keys, the worker pool and the refill, e.g. in a forked child.
+
+        The keys are dropped so the parent and the child never hand out the same key.
+        """
+        self._keys.clear()
+        self._pool = None
+        self._refill = None
+        self._wanted = None
+
+    async def get(self) -> PrivateKey:
+        """Takes a key from memory, from disk, or generates one if the pool is empty."""
+        if self._keys:
+            key = self._keys.popleft()
+            KEY_POOL_TAKEN_MEMORY.inc()
+        else:
+            key = None
+            if self._spilled:
+                key = await self._run_io(self._unspill)
+            if key is not None:
+                KEY_POOL_TAKEN_DISK.inc()
+            else:
+                key = await self._generate()
+                KEY_POOL_TAKEN_GENERATED.inc()
+        if self._wanted is not None:
+            self._wanted.set()
+        return key
+
+    async def get_many(self, count: int) -> List[PrivateKey]:
+        """Takes count keys, see get."""
+        return list(await asyncio.gather(*[self.get() for _ in range(count)]))
+
+    async def _run_refill(self):
+        if self.spill_directory:
+            # keys spilled before a restart are used first
+            self._spilled = await self._run_io(self._count_spilled)
+        while True:
+            try:
+                await self._refill_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Failed to refill the key pool: {e}")
+                await asyncio.sleep(1)
+
+    async def _refill_once(self):
+        missing = self.size - len(self._keys)
+        if missing > 0 and self._spilled:
+            key = await self._run_io(self._unspill)
+            if key is not None:
+                self._keys.append(key)
+                return
+        if missing > 0:
+            keys = await asyncio.gather(
+                *[self._generate() for _ in range(min(missing, self.workers))]
+            )
+            self._keys.extend(keys)
+            KEY_POOL_REFILLS_MEMORY.inc(len(keys))
+            return
+        if self.spill_size:
+            # recounted as other workers sharing the directory spill and claim keys too
+            self._spilled = await self._run_io(self._count_spilled)
+        spill_missing = self.spill_size - self._spilled
+        if spill_missing > 0:
+            keys = await asyncio.gather(
+                *[self._generate() for _ in range(min(spill_missing, self.workers))]
+            )
+            for key in keys:
+                await self._run_io(self._spill, key)
+            KEY_POOL_REFILLS_DISK.inc(len(keys))
+            return
+        self._wanted.clear()  # type: ignore
+        await self._wanted.wait()  # type: ignore
+
+    async def _generate(self) -> PrivateKey:
+        start = perf_counter()
+        key = await self._run(
+            _generate, self.key_type, self.key_size, self.executor == "process"
+        )
+        KEY_GENERATION.observe(perf_counter() - start)
+        return _load_key(key) if isinstance(key, bytes) else key
+
+    def _count_spilled(self) -> int:
+        return sum(
+            1 for name in os.listdir(self.spill_directory) if name.endswith(".pem")  # type: ignore
+        )
+
+    def _spill(self, key: PrivateKey):
+        data = key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.BestAvailableEncryption(
+                self._passphrase  # type: ignore
+            ),
+        )
+        path = os.path.join(self.spill_directory, uuid.uuid4().hex)  # type: ignore
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # only complete files are visible under the .pem name
+        os.replace(path + ".tmp", path + ".pem")
+        self._spilled += 1
+
+    def _unspill(self) -> Optional[PrivateKey]:
+        for name in os.listdir(self.spill_directory):  # type: ignore
+            if not name.endswith(".pem"):
+                continue
+            path = os.path.join(self.spill_directory, name)  # type: ignore
+            claimed = f"{path}.{os.getpid()}.claimed"
+            try:
+                # the rename succeeds for a single worker, so a key is never handed out twice
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            try:
+                with open(claimed, "rb") as f:
+                    data = f.read()
+            finally:
+                os.unlink(claimed)
+            self._spilled = max(0, self._spilled - 1)
+            return _load_key(data, self._passphrase)
+        self._spilled = 0
+        return None
+
+    async def _run(self, fn, *args):
+        if self._pool is None:
+            self._pool = (
+                ProcessPoolExecutor(max_workers=self.workers)
+                if self.executor == "process"
+                else ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="FasterAPI-keypool"
+                )
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, fn, *args)
+
+    async def _run_io(self, fn, *args):
+        # spill files are read and written on the default thread pool, also with a
+        # process executor, so keys never cross processes unencrypted
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+key_pool = KeyPool(
+    KEY_POOL_SIZE,
+    key_type=KEY_POOL_KEY_TYPE,
+    key_size=KEY_POOL_KEY_SIZE,
+    workers=KEY_POOL_WORKERS,
+    executor=KEY_POOL_EXECUTOR,
+    spill_directory=KEY_POOL_SPILL_DIRECTORY,
+    spill_size=KEY_POOL_SPILL_SIZE,
+    spill_passphrase=KEY_POOL_SPILL_PASSPHRASE,
+)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=key_pool.reset)
+
+registry.register(
+    Gauge(
+        "fasterapi_key_pool_depth",
+        "Pre-generated private keys waiting in memory.",
+        callback=lambda: key_pool.depth,
+    )
+)
+registry.register(
+    Gauge(
+        "fasterapi_key_pool_spilled",
+        "Pre-generated private keys waiting encrypted on disk.",
+        callback=lambda: key_pool.spilled,
+    )
+)
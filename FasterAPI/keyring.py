@@ -0,0 +1,200 @@
+import os
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from cryptography.hazmat.primitives import serialization
+from jose import JWTError, jwk, jwt
+
+from . import logger
+from .cert import generate_private_key
+from .essentials import (
+    ALGORITHM,
+    KEY_DIRECTORY,
+    KEY_ROTATION_INTERVAL,
+    SECRET_KEY,
+    TOKEN_EXPIRATION_TIME,
+)
+
+# key type and size used to generate keys for each asymmetric algorithm
+ASYMMETRIC_ALGORITHMS = {
+    "RS256": ("rsa", 2048),
+    "RS384": ("rsa", 3072),
+    "RS512": ("rsa", 4096),
+    "ES256": ("ec", 256),
+    "ES384": ("ec", 384),
+    "ES512": ("ec", 521),
+}
+
+
+@dataclass
+class SigningKey:
+    """A private signing key identified by its kid."""
+
+    kid: str
+    algorithm: str
+    private_pem: bytes
+    public_pem: bytes
+    created_at: float
+
+    def public_jwk(self) -> Dict:
+        """Returns the public key as a JWK."""
+        key = jwk.construct(self.public_pem, self.algorithm).to_dict()
+        key.update({"kid": self.kid, "use": "sig"})
+        return {k: v.decode() if isinstance(v, bytes) else v for k, v in key.items()}
+
+
+class KeyRing:
+    """A set of asymmetric signing keys selected by kid, with scheduled rotation.
+
+    Keys are kept as PEM files in a directory shared by every worker, named by their
+    kid. The newest key signs new tokens. Retired keys stay available for verification
+    until every token they signed has expired, then they are deleted.
+    """
+
+    def __init__(self, algorithm: str, directory: str, rotation_interval: float):
+        self.algorithm = algorithm
+        self.directory = directory
+        self.rotation_interval = rotation_interval
+        self._keys: Dict[str, SigningKey] = {}
+        self._jwks: Optional[Dict] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def current(self) -> SigningKey:
+        """The key used to sign new tokens."""
+        if not self._keys:
+            self.load()
+        if not self._keys:
+            self.rotate()
+        return max(self._keys.values(), key=lambda key: key.created_at)
+
+    def load(self):
+        """Loads every key in the directory."""
+        os.makedirs(self.directory, exist_ok=True)
+        keys = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".pem"):
+                continue
+            kid = filename[: -len(".pem")]
+            with open(os.path.join(self.directory, filename), "rb") as f:
+                keys[kid] = self._signing_key(kid, f.read())
+        with self._lock:
+            self._keys = keys
+            self._jwks = None
+            self._loaded_at = time.time()
+
+    def rotate(self) -> SigningKey:
+        """Generates a new signing key and retires keys no longer needed for verification."""
+        key_type, key_size = ASYMMETRIC_ALGORITHMS[self.algorithm]
+        private_key = generate_private_key(key_type, key_size)
+        private_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+        created_at = time.time()
+        kid = f"{int(created_at)}-{secrets.token_hex(4)}"
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{kid}.pem")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(private_pem)
+        key = self._signing_key(kid, private_pem)
+        with self._lock:
+            self._keys[kid] = key
+            self._jwks = None
+        self._retire(created_at)
+        logger.info(f"Signing key {kid} created.")
+        return key
+
+    def maybe_rotate(self) -> bool:
+        """Rotates the signing key if the current one is older than the rotation interval."""
+        self.load()
+        if time.time() - self.current.created_at < self.rotation_interval:
+            return False
+        self.rotate()
+        return True
+
+    def encode(self, claims: Dict) -> str:
+        """Signs the claims with the current key."""
+        key = self.current
+        return jwt.encode(
+            claims,
+            key.private_pem.decode(),
+            algorithm=self.algorithm,
+            headers={"kid": key.kid},
+        )
+
+    def decode(self, token: str) -> Dict:
+        """Verifies the token with the key named by its kid."""
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self._keys.get(kid)  # type: ignore
+        if key is None and time.time() - self._loaded_at > 1:
+            # the key may have been created by another worker
+            self.load()
+            key = self._keys.get(kid)  # type: ignore
+        if key is None:
+            raise JWTError("Unknown signing key.")
+        return jwt.decode(token, key.public_pem.decode(), algorithms=[self.algorithm])
+
+    def jwks(self) -> Dict:
+        """Returns the public keys as a JWK set."""
+        if self._jwks is None:
+            self.current  # make sure there is at least one key
+            self._jwks = {"keys": [key.public_jwk() for key in self._keys.values()]}
+        return self._jwks
+
+    def _signing_key(self, kid: str, private_pem: bytes) -> SigningKey:
+        private_key = serialization.load_pem_private_key(private_pem, password=None)
+        public_pem = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+        return SigningKey(
+            kid=kid,
+            algorithm=self.algorithm,
+            private_pem=private_pem,
+            public_pem=public_pem,
+            created_at=float(kid.split("-")[0]),
+        )
+
+    def _retire(self, now: float):
+        # a superseded key keeps verifying the tokens it signed for one token lifetime
+        keys: List[SigningKey] = sorted(
+            self._keys.values(), key=lambda key: key.created_at
+        )
+        for key, successor in zip(keys, keys[1:]):
+            if successor.created_at + TOKEN_EXPIRATION_TIME * 60 >= now:
+                continue
+            with self._lock:
+                self._keys.pop(key.kid, None)
+                self._jwks = None
+            try:
+                os.remove(os.path.join(self.directory, f"{key.kid}.pem"))
+            except FileNotFoundError:
+                pass
+
+
+keyring = (
+    KeyRing(ALGORITHM, KEY_DIRECTORY, KEY_ROTATION_INTERVAL * 3600)
+    if ALGORITHM in ASYMMETRIC_ALGORITHMS
+    else None
+)
+
+
+def encode_token(claims: Dict) -> str:
+    """Signs the claims with the configured algorithm."""
+    if keyring is not None:
+        return keyring.encode(claims)
+    return jwt.encode(claims, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def decode_token(token: str) -> Dict:
+    """Verifies the token and returns its claims, raises JWTError if invalid."""
+    if keyring is not None:
+        return keyring.decode(token)
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
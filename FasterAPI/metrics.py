@@ -0,0 +1,440 @@
+from bisect import bisect_left
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+
+class PoolMetrics:
+    """Counters of connection pool checkouts, waits and timeouts."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.checkout_seconds = 0.0
+        self.checkout_seconds_max = 0.0
+
+    def observe(self, elapsed: float, waited: bool):
+        self.checkouts += 1
+        self.checkout_seconds += elapsed
+        if elapsed > self.checkout_seconds_max:
+            self.checkout_seconds_max = elapsed
+        if waited:
+            self.waits += 1
+            self.wait_seconds += elapsed
+
+    def snapshot(self, pool: Pool) -> Dict:
+        """Returns the counters together with the current state of the pool."""
+        stats: Dict = {
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "timeouts": self.timeouts,
+            "wait_seconds_total": self.wait_seconds,
+            "checkout_seconds_total": self.checkout_seconds,
+            "checkout_seconds_max": self.checkout_seconds_max,
+        }
+        if isinstance(pool, QueuePool):
+            stats.update(
+                {
+                    "size": pool.size(),
+                    "checked_in": pool.checkedin(),
+                    "checked_out": pool.checkedout(),
+                    "overflow": pool.overflow(),
+                }
+            )
+        return stats
+
+
+pool_metrics = PoolMetrics()
+
+
+class _InstrumentedPoolMixin:
+    """Times every connection checkout and records waits on an exhausted pool."""
+
+    def _do_get(self):
+        pool: QueuePool = self  # type: ignore
+        waited = (
+            pool.checkedin() == 0
+            and pool._max_overflow > -1
+            and pool._overflow >= pool._max_overflow
+        )
+        start = perf_counter()
+        try:
+            return super()._do_get()  # type: ignore
+        except exc.TimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        finally:
+            pool_metrics.observe(perf_counter() - start, waited)
+
+
+class InstrumentedQueuePool(_InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(_InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    """A metric family with children per label values.
+
+    Children are created once per label combination and meant to be bound up front,
+    e.g. `LOGIN_SUCCESS = logins.labels("success")`, so the hot path is a plain
+    attribute update with no locking or lookups.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def labels(self, *values: str) -> Any:
+        """Returns the child of the label values, creating it on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}.")
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def expose(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for values, child in list(self._children.items()):
+            lines.extend(
+                child.expose(self.name, _format_labels(self.labelnames, values))
+            )
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value", "callback")
+
+    def __init__(self, callback: Optional[Callable[[], float]] = None):
+        self.value = 0.0
+        self.callback = callback
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def expose(self, name: str, labels: str) -> List[str]:
+        value = self.callback() if self.callback is not None else self.value
+        return [f"{name}{labels} {value}"]
+
+
+class Counter(_Metric):
+    """A monotonically increasing counter, optionally read from a callback at scrape time."""
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], float]] = None,
+    ):
+        self._callback = callback
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _CounterChild(self._callback)
+
+    def inc(self, amount: float = 1):
+        self._children[()].inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ("value", "callback")
+
+    def __init__(self, callback: Optional[Callable[[], float]] = None):
+        self.value = 0.0
+        self.callback = callback
+
+    def set(self, value: float):
+        self.value = value
+
+    def expose(self, name: str, labels: str) -> List[str]:
+        value = self.callback() if self.callback is not None else self.value
+        return [f"{name}{labels} {value}"]
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, optionally read from a callback at scrape time."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], float]] = None,
+    ):
+        self._callback = callback
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _GaugeChild(self._callback)
+
+    def set(self, value: float):
+        self._children[()].set(value)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def expose(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        inner = labels[1:-1] + "," if labels else ""
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{inner}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Observations counted into fixed buckets."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+
+class Registry:
+    """A collection of metrics exposed together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> Any:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def expose(self) -> str:
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_DURATION = registry.register(
+    Histogram(
+        "fasterapi_http_request_duration_seconds",
+        "HTTP request latency by route.",
+        ["method", "route", "status"],
+    )
+)
+AUTH_DURATION = registry.register(
+    Histogram(
+        "fasterapi_auth_duration_seconds",
+        "Time spent in the authenticated dependency by phase.",
+        ["phase"],
+    )
+)
+AUTH_CACHE = AUTH_DURATION.labels("cache")
+AUTH_DB = AUTH_DURATION.labels("db")
+AUTH_JWT = AUTH_DURATION.labels("jwt")
+PASSWORD_HASH_DURATION = registry.register(
+    Histogram(
+        "fasterapi_password_hash_duration_seconds",
+        "Time spent hashing or verifying passwords, including time queued for a worker.",
+        ["operation"],
+        buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    )
+)
+PASSWORD_HASH = PASSWORD_HASH_DURATION.labels("hash")
+PASSWORD_VERIFY = PASSWORD_HASH_DURATION.labels("verify")
+LOGINS = registry.register(
+    Counter("fasterapi_logins_total", "Login attempts by result.", ["result"])
+)
+LOGIN_SUCCESS = LOGINS.labels("success")
+LOGIN_FAILURE = LOGINS.labels("failure")
+TOKEN_REFRESHES = registry.register(
+    Counter(
+        "fasterapi_token_refreshes_total",
+        "Token refresh attempts by result.",
+        ["result"],
+    )
+)
+TOKEN_REFRESH_SUCCESS = TOKEN_REFRESHES.labels("success")
+TOKEN_REFRESH_INVALID = TOKEN_REFRESHES.labels("invalid")
+TOKEN_REFRESH_REUSED = TOKEN_REFRESHES.labels("reused")
+BLACKLISTED_TOKENS = registry.register(
+    Gauge("fasterapi_blacklisted_tokens", "Unexpired blacklisted tokens.")
+)
+ACTIVE_SESSIONS = registry.register(
+    Gauge("fasterapi_active_sessions", "Unexpired active sessions.")
+)
+REAPER_DURATION = registry.register(
+    Histogram(
+        "fasterapi_reaper_duration_seconds",
+        "Duration of each run of the expired row reaper.",
+    )
+)
+REAPER_RECLAIMED = registry.register(
+    Counter(
+        "fasterapi_reaper_reclaimed_total",
+        "Expired rows deleted by the reaper by table.",
+        ["table"],
+    )
+)
+REAPER_RECLAIMED_TOKENS = REAPER_RECLAIMED.labels("blacklisted_tokens")
+REAPER_RECLAIMED_SESSIONS = REAPER_RECLAIMED.labels("active_sessions")
+DB_READS = registry.register(
+    Counter(
+        "fasterapi_db_reads_total",
+        "Read-only database sessions routed to the primary or a read replica.",
+        ["target"],
+    )
+)
+DB_READS_PRIMARY = DB_READS.labels("primary")
+DB_READS_REPLICA = DB_READS.labels("replica")
+REPLICA_LAG = registry.register(
+    Gauge(
+        "fasterapi_replica_lag_seconds",
+        "Seconds each read replica lags behind the primary, -1 while unusable.",
+        ["replica"],
+    )
+)
+KEY_GENERATION = registry.register(
+    Histogram(
+        "fasterapi_key_generation_seconds",
+        "Time spent generating private keys for the key pool, including time queued for a worker.",
+        buckets=(0.001, 0.005, 0.025, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+    )
+)
+KEY_POOL_REFILLS = registry.register(
+    Counter(
+        "fasterapi_key_pool_refills_total",
+        "Private keys generated by the key pool refill by destination.",
+        ["target"],
+    )
+)
+KEY_POOL_REFILLS_MEMORY = KEY_POOL_REFILLS.labels("memory")
+KEY_POOL_REFILLS_DISK = KEY_POOL_REFILLS.labels("disk")
+KEY_POOL_TAKEN = registry.register(
+    Counter(
+        "fasterapi_key_pool_taken_total",
+        "Private keys taken from the key pool by source, generated when it was empty.",
+        ["source"],
+    )
+)
+KEY_POOL_TAKEN_MEMORY = KEY_POOL_TAKEN.labels("memory")
+KEY_POOL_TAKEN_DISK = KEY_POOL_TAKEN.labels("disk")
+KEY_POOL_TAKEN_GENERATED = KEY_POOL_TAKEN.labels("generated")
+
+
+def register_pool_metrics(get_pool: Callable[[], Pool]):
+    """Exposes the connection pool metrics of the pool returned by get_pool."""
+
+    def _stat(key: str) -> Callable[[], float]:
+        return lambda: pool_metrics.snapshot(get_pool()).get(key, 0)
+
+    for key, metric, documentation in (
+        ("checkouts", Counter, "Connection checkouts from the pool."),
+        ("waits", Counter, "Checkouts that waited on an exhausted pool."),
+        ("timeouts", Counter, "Checkouts that timed out on an exhausted pool."),
+        ("wait_seconds_total", Counter, "Time spent waiting on an exhausted pool."),
+        ("checkout_seconds_total", Counter, "Time spent checking out connections."),
+        ("checked_out", Gauge, "Connections currently checked out."),
+        ("overflow", Gauge, "Connections open beyond the pool size."),
+    ):
+        name = "fasterapi_db_pool_" + key.replace("_total", "")
+        if metric is Counter:
+            name += "_total"
+        registry.register(metric(name, documentation, callback=_stat(key)))
+
+
+class MetricsMiddleware:
+    """An ASGI middleware that records the latency of each request by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = perf_counter()
+        status_code = [500]
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            route = scope.get("route")
+            REQUEST_DURATION.labels(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code[0]),
+            ).observe(perf_counter() - start)
@@ -0,0 +1,68 @@
+import hashlib
+from datetime import datetime
+
+from sqlalchemy import Connection, DateTime, String, inspect, text
+
+from . import logger
+from .models import ActiveSession, BlacklistedToken
+
+
+def migrate_blacklisted_tokens(connection: Connection):
+    """Replaces the full JWT column of blacklisted_tokens with a SHA-256 digest column.
+
+    Tables created before token digests were introduced store and index the whole
+    encoded token. The unexpired rows are carried over as digests, expired ones are
+    dropped as the cleanup task would have done.
+    """
+    columns = {
+        column["name"]
+        for column in inspect(connection).get_columns(BlacklistedToken.__tablename__)
+    }
+    if "token" not in columns or "token_hash" in columns:
+        return
+    rows = connection.execute(
+        text("SELECT token, exp FROM blacklisted_tokens WHERE exp >= :now")
+        .bindparams(now=datetime.now())
+        .columns(token=String, exp=DateTime)
+    ).all()
+    connection.execute(text("DROP TABLE blacklisted_tokens"))
+    BlacklistedToken.__table__.create(connection)  # type: ignore
+    if rows:
+        connection.execute(
+            BlacklistedToken.__table__.insert(),  # type: ignore
+            [
+                {"token_hash": hashlib.sha256(token.encode()).hexdigest(), "exp": exp}
+                for token, exp in rows
+            ],
+        )
+    logger.info(f"Migrated {len(rows)} blacklisted tokens to digests.")
+
+
+def migrate_active_sessions(connection: Connection):
+    """Brings active_sessions up to per-token sessions with refresh tokens.
+
+    Tables from before sessions were tracked per token hold a single row per user and
+    no session id. Their rows are not carried over, since the tokens they belong to
+    carry no session id either, so those users simply log in again.
+    """
+    columns = {
+        column["name"]
+        for column in inspect(connection).get_columns(ActiveSession.__tablename__)
+    }
+    if "sid" not in columns:
+        connection.execute(text("DROP TABLE active_sessions"))
+        ActiveSession.__table__.create(connection)  # type: ignore
+        logger.info("Recreated active_sessions with per-token sessions.")
+    elif "refresh_hash" not in columns:
+        connection.execute(
+            text("ALTER TABLE active_sessions ADD COLUMN refresh_hash VARCHAR(64)")
+        )
+        logger.info("Added refresh tokens to active_sessions.")
+
+
+def migrate_database(connection: Connection):
+    """Brings tables created by older versions up to date."""
+    if inspect(connection).has_table(BlacklistedToken.__tablename__):
+        migrate_blacklisted_tokens(connection)
+    if inspect(connection).has_table(ActiveSession.__tablename__):
+        migrate_active_sessions(connection)
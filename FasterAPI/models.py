@@ -1,6 +1,6 @@
-from typing import List
+from typing import List, Optional
 from datetime import datetime
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, String
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -21,7 +21,7 @@ class User(Base):
     privileges: Mapped[List["UserPrivilege"]] = relationship(
         back_populates="user", cascade="all,delete"
     )
-    session: Mapped["ActiveSession"] = relationship(
+    sessions: Mapped[List["ActiveSession"]] = relationship(
         back_populates="user", cascade="all,delete"
     )
 
@@ -41,12 +41,14 @@ class ActiveSession(Base):
 
     __tablename__ = "active_sessions"
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
-    username: Mapped[str] = mapped_column(
-        ForeignKey("users.username"), index=True, unique=True
-    )
+    sid: Mapped[str] = mapped_column(String(64), unique=True, index=True)
+    username: Mapped[str] = mapped_column(ForeignKey("users.username"), index=True)
     client: Mapped[str]
+    user_agent: Mapped[str] = mapped_column(default="")
+    refresh_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    created_at: Mapped[datetime]
     exp: Mapped[datetime]
-    user: Mapped["User"] = relationship("User", back_populates="session")
+    user: Mapped["User"] = relationship("User", back_populates="sessions")
 
 
 class BlacklistedToken(Base):
@@ -54,5 +56,22 @@ class BlacklistedToken(Base):
 
     __tablename__ = "blacklisted_tokens"
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
-    token: Mapped[str] = mapped_column(unique=True, index=True)
+    token_hash: Mapped[str] = mapped_column(String(64), unique=True, index=True)
     exp: Mapped[datetime]
+
+
+class ReplicaHeartbeat(Base):
+    """Timestamp written to the primary to measure how far read replicas lag behind"""
+
+    __tablename__ = "replica_heartbeats"
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    written_at: Mapped[float]
+
+
+class MaintenanceLease(Base):
+    """Lease electing the one worker that runs a maintenance job"""
+
+    __tablename__ = "maintenance_leases"
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    owner: Mapped[str] = mapped_column(String(64))
+    expires_at: Mapped[datetime]
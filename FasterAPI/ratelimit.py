@@ -0,0 +1,158 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+from fastapi import HTTPException, status
+
+from . import logger
+from .essentials import (
+    LOGIN_RATE_LIMIT_PER_IP,
+    LOGIN_RATE_LIMIT_PER_USERNAME,
+    LOGIN_RATE_LIMIT_PERIOD,
+    RATE_LIMIT_BACKEND,
+    RATE_LIMIT_URL,
+    SESSION_STORE_POOL_SIZE,
+    SESSION_STORE_PREFIX,
+)
+from .metrics import Counter, registry
+from .store import RedisClient
+
+LOGIN_RATE_LIMITED = registry.register(
+    Counter(
+        "fasterapi_login_rate_limited_total",
+        "Login attempts rejected by the rate limiter, by the limit they hit.",
+        ["limit"],
+    )
+)
+LOGIN_RATE_LIMITED_IP = LOGIN_RATE_LIMITED.labels("ip")
+LOGIN_RATE_LIMITED_USERNAME = LOGIN_RATE_LIMITED.labels("username")
+
+
+class RateLimiter:
+    """Token buckets keyed by string, each holding up to capacity tokens refilled over period seconds."""
+
+    async def hit(self, key: str, capacity: int, period: float) -> float:
+        """Takes a token from the bucket of the key.
+
+        Returns 0 if a token was taken, otherwise the seconds until one is available.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """Releases the connections of the limiter."""
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Keeps the buckets in process memory, so each worker limits on its own.
+
+    At most max_keys buckets are kept, the least recently hit are dropped beyond that,
+    so a flood of distinct keys cannot exhaust memory.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def hit(self, key: str, capacity: int, period: float) -> float:
+        rate = capacity / period
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        retry_after = 0.0
+        if tokens < 1:
+            retry_after = (1 - tokens) / rate
+        else:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+# refills and takes from a bucket atomically, returns the seconds to wait as a string
+_TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local retry_after = 0
+if tokens < 1 then
+    retry_after = (1 - tokens) / rate
+else
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return tostring(retry_after)
+"""
+
+
+class RedisRateLimiter(RateLimiter):
+    """Keeps the buckets in a Redis-protocol server, shared by every worker and replica."""
+
+    def __init__(self, client: RedisClient, prefix: str = "fasterapi:"):
+        self.client = client
+        self.prefix = prefix
+
+    async def hit(self, key: str, capacity: int, period: float) -> float:
+        retry_after = await self.client.execute(
+            "EVAL",
+            _TOKEN_BUCKET_SCRIPT,
+            1,
+            f"{self.prefix}ratelimit:{key}",
+            capacity,
+            repr(capacity / period),
+            repr(time.time()),
+        )
+        return float(retry_after)
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_rate_limiter(backend: str) -> RateLimiter:
+    """Returns the rate limiter of the backend, "memory" or "redis"."""
+    if backend == "memory":
+        return MemoryRateLimiter()
+    if backend == "redis":
+        return RedisRateLimiter(
+            RedisClient(RATE_LIMIT_URL, SESSION_STORE_POOL_SIZE), SESSION_STORE_PREFIX
+        )
+    raise ValueError(f"Unknown rate limiter {backend}.")
+
+
+rate_limiter = create_rate_limiter(RATE_LIMIT_BACKEND)
+
+
+async def check_login_rate(client: str, username: str):
+    """Rejects the login attempt with 429 if the client or the username is over its limit.
+
+    Meant to run before any database or password hashing work. If the shared backend
+    is unreachable, attempts are let through rather than locking everyone out.
+    """
+    for key, capacity, counter in (
+        (f"login:ip:{client}", LOGIN_RATE_LIMIT_PER_IP, LOGIN_RATE_LIMITED_IP),
+        (
+            f"login:user:{username.strip().lower()}",
+            LOGIN_RATE_LIMIT_PER_USERNAME,
+            LOGIN_RATE_LIMITED_USERNAME,
+        ),
+    ):
+        if capacity <= 0:
+            continue
+        try:
+            retry_after = await rate_limiter.hit(key, capacity, LOGIN_RATE_LIMIT_PERIOD)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Login rate limiter unavailable: {e}")
+            return
+        if retry_after > 0:
+            counter.inc()
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts, try again later",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import random
+import socket
+import uuid
+from datetime import timedelta
+from time import perf_counter
+from typing import Dict, Optional
+
+from . import logger
+from .essentials import (
+    REAPER_BATCH_SIZE,
+    REAPER_INTERVAL,
+    REAPER_JITTER,
+    AnySession,
+    open_db,
+)
+from .metrics import (
+    ACTIVE_SESSIONS,
+    BLACKLISTED_TOKENS,
+    REAPER_DURATION,
+    REAPER_RECLAIMED_SESSIONS,
+    REAPER_RECLAIMED_TOKENS,
+)
+from .revocation import revocation_index
+from .store import session_store
+
+REAPER_LEASE = "reaper"
+# identifies this worker as a lease owner, unique across hosts and restarts
+WORKER_ID = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+async def _update_gauges(db: AnySession):
+    counts = await session_store.counts(db)
+    if "blacklisted_tokens" in counts:
+        BLACKLISTED_TOKENS.set(counts["blacklisted_tokens"])
+    if "active_sessions" in counts:
+        ACTIVE_SESSIONS.set(counts["active_sessions"])
+
+
+async def reap_expired(
+    batch_size: int = REAPER_BATCH_SIZE,
+    owner: str = WORKER_ID,
+    ttl: Optional[timedelta] = None,
+) -> Optional[Dict[str, int]]:
+    """Deletes expired blacklisted tokens and active sessions in bounded batches.
+
+    Each batch is its own short transaction and the event loop is yielded to between
+    batches, so a large backlog never holds a long lock or stalls requests. Only the
+    worker holding the reaper lease deletes anything. Backends with native expiry only
+    trim what they do not expire themselves.
+
+    Args:
+        batch_size (int, optional): the maximum number of rows deleted per transaction. Defaults to REAPER_BATCH_SIZE.
+        owner (str, optional): the id of this worker. Defaults to WORKER_ID.
+        ttl (Optional[timedelta], optional): how long the lease is held. Defaults to twice the maximum interval.
+
+    Returns:
+        Optional[Dict[str, int]]: returns the rows deleted per table, or None if another worker holds the lease.
+    """
+    if ttl is None:
+        ttl = timedelta(seconds=2 * REAPER_INTERVAL * (1 + REAPER_JITTER))
+    async with open_db() as db:
+        if not await session_store.acquire_lease(db, REAPER_LEASE, owner, ttl):
+            return None
+        reclaimed = await session_store.reap(db, batch_size)
+    REAPER_RECLAIMED_TOKENS.inc(reclaimed["blacklisted_tokens"])
+    REAPER_RECLAIMED_SESSIONS.inc(reclaimed["active_sessions"])
+    return reclaimed
+
+
+async def _reap_expired_rows():
+    """A async task running the reaper every REAPER_INTERVAL seconds, with jitter."""
+    while True:
+        start = perf_counter()
+        try:
+            reclaimed = await reap_expired()
+            async with open_db() as db:
+                await _update_gauges(db)
+        except Exception as e:
+            reclaimed = None
+            logger.warning(f"Failed to reap expired rows: {e}")
+        revocation_index.prune()
+        elapsed = perf_counter() - start
+        if reclaimed is not None:
+            REAPER_DURATION.observe(elapsed)
+            log = logger.info if any(reclaimed.values()) else logger.debug
+            log(
+                f"Reaped {reclaimed['blacklisted_tokens']} expired tokens and "
+                f"{reclaimed['active_sessions']} expired sessions in {elapsed:.3f}s."
+            )
+        await asyncio.sleep(
+            REAPER_INTERVAL * (1 + random.uniform(-REAPER_JITTER, REAPER_JITTER))
+        )
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional
+
+from fastapi import Depends
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from . import logger
+from .essentials import (
+    ASYNC_DATABASE,
+    READ_REPLICA_URLS,
+    READ_YOUR_WRITES_WINDOW,
+    REPLICA_CHECK_INTERVAL,
+    REPLICA_MAX_LAG,
+    AnySession,
+    get_db,
+    open_db,
+    open_engine,
+    run_db,
+)
+from .metrics import DB_READS_PRIMARY, DB_READS_REPLICA, REPLICA_LAG
+from .models import ReplicaHeartbeat
+
+HEARTBEAT = "primary"
+# usernames remembered as recently written, the oldest are forgotten beyond it
+_MAX_RECENT_WRITES = 100_000
+
+
+def _write_heartbeat(db: Session, now: float):
+    heartbeat = db.get(ReplicaHeartbeat, HEARTBEAT)
+    if heartbeat is None:
+        db.add(ReplicaHeartbeat(name=HEARTBEAT, written_at=now))
+    else:
+        heartbeat.written_at = now
+    db.commit()
+
+
+def _read_heartbeat(db: Session) -> Optional[float]:
+    heartbeat = db.get(ReplicaHeartbeat, HEARTBEAT)
+    return None if heartbeat is None else heartbeat.written_at
+
+
+class ReplicaRouter:
+    """Routes read-only queries to read replicas that keep up with the primary.
+
+    The singleton worker writes a heartbeat timestamp to the primary every
+    check_interval seconds and every worker reads it back from each replica. A replica
+    whose heartbeat is older than max_lag plus the interval, or that cannot be reached,
+    is skipped until it catches up, and reads fall back to the primary when no replica
+    is usable. Reads about a user this worker wrote within the last window seconds go
+    to the primary, so a client sees its own logins, logouts and changes.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        max_lag: float = 5,
+        check_interval: float = 2,
+        window: float = 10,
+    ):
+        self.urls = urls
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.window = window
+        self.engines: List[Any] = []
+        self.sessionmakers: List[Any] = []
+        for url in urls:
+            engine, sessionmaker = open_engine(url)
+            self.engines.append(engine)
+            self.sessionmakers.append(sessionmaker)
+        # seconds each replica lags behind, None until measured or when unreachable
+        self.lags: List[Optional[float]] = [None] * len(urls)
+        self._next = 0
+        self._recent_writes: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.engines)
+
+    def note_write(self, *usernames: str):
+        """Sends reads about the users to the primary for the next window seconds."""
+        if not self.enabled:
+            return
+        until = time.monotonic() + self.window
+        with self._lock:
+            for username in usernames:
+                self._recent_writes.pop(username, None)
+                self._recent_writes[username] = until
+            while len(self._recent_writes) > _MAX_RECENT_WRITES:
+                self._recent_writes.popitem(last=False)
+
+    def wrote_recently(self, *usernames: str) -> bool:
+        """Returns whether this worker wrote any of the users within the window."""
+        now = time.monotonic()
+        with self._lock:
+            for username in usernames:
+                until = self._recent_writes.get(username)
+                if until is None:
+                    continue
+                if until > now:
+                    return True
+                del self._recent_writes[username]
+        return False
+
+    def _pick(self) -> Optional[int]:
+        """Returns the index of the next usable replica, round robin, or None."""
+        limit = self.max_lag + self.check_interval
+        for _ in range(len(self.engines)):
+            index = self._next
+            self._next = (self._next + 1) % len(self.engines)
+            lag = self.lags[index]
+            if lag is not None and lag <= limit:
+                return index
+        return None
+
+    @asynccontextmanager
+    async def read_db(
+        self, db: AnySession, *usernames: str
+    ) -> AsyncIterator[AnySession]:
+        """Yields a session of a usable replica for read-only queries, or db itself.
+
+        Args:
+            db (AnySession): the primary session, yielded when no replica should be used.
+            *usernames (str): the users read, read from the primary if recently written.
+        """
+        index = None
+        if self.enabled and not self.wrote_recently(*usernames):
+            index = self._pick()
+        if index is None:
+            DB_READS_PRIMARY.inc()
+            yield db
+            return
+        DB_READS_REPLICA.inc()
+        async with _session(self.sessionmakers[index]) as replica_db:
+            yield replica_db
+
+    async def read(
+        self,
+        db: AnySession,
+        fn: Callable[[AnySession], Awaitable[Any]],
+        *usernames: str,
+        retry: Callable[[Any], bool] = lambda result: result is None,
+    ) -> Any:
+        """Returns `await fn(session)` read from a usable replica, or from the primary.
+
+        The read is repeated on the primary if the replica fails or retry(result) is
+        true, e.g. when a row written moments ago by another worker has not reached the
+        replica yet.
+
+        Args:
+            db (AnySession): the primary session.
+            fn (Callable[[AnySession], Awaitable[Any]]): the read-only queries.
+            *usernames (str): the users read, read from the primary if recently written.
+            retry (Callable[[Any], bool], optional): whether to repeat the read on the primary. Defaults to a None result.
+
+        Returns:
+            Any: returns the result of fn.
+        """
+        index = None
+        if self.enabled and not self.wrote_recently(*usernames):
+            index = self._pick()
+        if index is not None:
+            try:
+                async with _session(self.sessionmakers[index]) as replica_db:
+                    result = await fn(replica_db)
+                DB_READS_REPLICA.inc()
+                if not retry(result):
+                    return result
+            except DBAPIError as e:
+                logger.warning(f"Read replica {index} failed, reading the primary: {e}")
+                self.lags[index] = None
+        DB_READS_PRIMARY.inc()
+        return await fn(db)
+
+    async def write_heartbeat(self):
+        """Writes the current time to the heartbeat row of the primary."""
+        async with open_db() as db:
+            await run_db(db, _write_heartbeat, time.time())
+
+    async def check_lag(self):
+        """Measures how far each replica lags behind from its copy of the heartbeat."""
+        for index, sessionmaker in enumerate(self.sessionmakers):
+            try:
+                async with _session(sessionmaker) as db:
+                    written_at = await run_db(db, _read_heartbeat)
+            except Exception as e:
+                if self.lags[index] is not None:
+                    logger.warning(f"Read replica {index} is unreachable: {e}")
+                self.lags[index] = None
+            else:
+                self.lags[index] = (
+                    None if written_at is None else max(0.0, time.time() - written_at)
+                )
+            lag = self.lags[index]
+            REPLICA_LAG.labels(str(index)).set(-1 if lag is None else lag)
+
+    def dispose(self):
+        """Drops the pooled replica connections, e.g. in a forked child."""
+        for engine in self.engines:
+            getattr(engine, "sync_engine", engine).dispose(close=False)
+
+
+@asynccontextmanager
+async def _session(sessionmaker) -> AsyncIterator[AnySession]:
+    if ASYNC_DATABASE:
+        async with sessionmaker() as db:
+            yield db
+    else:
+        db = sessionmaker()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+replica_router = ReplicaRouter(
+    READ_REPLICA_URLS,
+    max_lag=REPLICA_MAX_LAG,
+    check_interval=REPLICA_CHECK_INTERVAL,
+    window=READ_YOUR_WRITES_WINDOW,
+)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=replica_router.dispose)
+
+
+async def get_read_db(db: AnySession = Depends(get_db)):
+    """A dependency yielding a replica session for read-only endpoints, or the primary one."""
+    async with replica_router.read_db(db) as read_db:
+        yield read_db
+
+
+async def _monitor_replicas(heartbeat: bool = True):
+    """A async task writing the heartbeat, if heartbeat is True, and measuring the replica lag."""
+    while True:
+        try:
+            if heartbeat:
+                await replica_router.write_heartbeat()
+            await replica_router.check_lag()
+        except Exception as e:
+            logger.warning(f"Failed to check the read replicas: {e}")
+        await asyncio.sleep(replica_router.check_interval)
@@ -0,0 +1,103 @@
+import hashlib
+import math
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+from .essentials import REVOCATION_INDEX, REVOCATION_INDEX_CAPACITY
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter over byte strings."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.size = max(
+            int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)), 8
+        )
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: bytes):
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: bytes):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: bytes) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class RevocationIndex:
+    """An in-process index of unexpired revoked tokens.
+
+    A Bloom filter answers "definitely not revoked" for almost every request, backed by
+    an exact set of token digests and their expiry so the filter can be rebuilt when
+    expired tokens are pruned. Only tokens that hit the index need a database check.
+    """
+
+    def __init__(self, capacity: int = 100_000, enabled: bool = True):
+        self.enabled = enabled
+        self.capacity = capacity
+        self.last_id = 0
+        self._digests: Dict[bytes, float] = {}
+        self._filter = BloomFilter(capacity)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def might_contain(self, token: str) -> bool:
+        """Returns False if the token is certainly not revoked."""
+        if not self.enabled:
+            return True
+        return self.might_contain_digest(hashlib.sha256(token.encode()).digest())
+
+    def might_contain_digest(self, digest: bytes) -> bool:
+        """Returns False if the digest is certainly not revoked."""
+        if not self.enabled:
+            return True
+        return digest in self._filter and digest in self._digests
+
+    def add(self, token: str, exp: float):
+        """Records a revoked token until its expiration timestamp."""
+        self.add_digest(hashlib.sha256(token.encode()).digest(), exp)
+
+    def add_digest(self, digest: bytes, exp: float):
+        """Records a revoked token digest until its expiration timestamp."""
+        with self._lock:
+            self._digests[digest] = exp
+            if len(self._digests) > self.capacity:
+                self._rebuild(self.capacity * 2)
+            else:
+                self._filter.add(digest)
+
+    def load(self, entries: Iterable[Tuple[int, bytes, float]]):
+        """Adds (row id, digest, exp) entries and remembers the highest row id seen."""
+        for row_id, digest, exp in entries:
+            self.add_digest(digest, exp)
+            self.last_id = max(self.last_id, row_id)
+
+    def prune(self, now: float = 0):
+        """Drops tokens that have expired and rebuilds the filter."""
+        now = now or time.time()
+        with self._lock:
+            self._digests = {d: exp for d, exp in self._digests.items() if exp > now}
+            self._rebuild(self.capacity)
+
+    def _rebuild(self, capacity: int):
+        self.capacity = max(capacity, len(self._digests))
+        self._filter = BloomFilter(self.capacity)
+        for digest in self._digests:
+            self._filter.add(digest)
+
+
+revocation_index = RevocationIndex(REVOCATION_INDEX_CAPACITY, REVOCATION_INDEX)
@@ -1,18 +1,39 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, status
+from typing import AsyncIterator, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from jose import JWTError
-from sqlalchemy.orm import Session
+from jose import JWTError, jwt
+from sqlalchemy.orm import Session, selectinload
 
-from .essentials import ALLOW_SELF_REGISTRATION, TOKEN_URL, get_db, oauth2_scheme, pwd_context
+from .cache import token_cache, username_cache
+from .essentials import (ALLOW_SELF_REGISTRATION, METRICS_URL, REFRESH_TOKEN_EXPIRATION_TIME,
+                         STATELESS_TOKENS, TOKEN_URL, AnySession, Engine, get_db, oauth2_scheme,
+                         open_db, run_db)
 from .dependencies import authenticated, is_superuser
+from .hashing import password_hasher
+from .keyring import keyring
+from .metrics import LOGIN_FAILURE, LOGIN_SUCCESS, pool_metrics, registry
 from .models import User, UserPrivilege
-from .schemas import UserCreate, UserRead, UserUpdate
+from .ratelimit import check_login_rate
+from .replica import get_read_db, replica_router
+from .store import session_store
+from .schemas import (BulkResult, PrivilegeGrant, SessionInfo, TokenRefresh, UserCreate, UserRead,
+                      UserUpdate)
 from .utils import (
     authenticate_user,
     blacklist_token,
     create_access_token,
     create_session,
+    end_sessions,
+    get_user_by_username,
+    grant_privileges,
     register_user,
+    new_refresh_token,
+    new_session_id,
+    refresh_session,
+    register_users,
+    user_claims,
 )
 
 auth_router = APIRouter(tags=["Authentication"])
@@ -22,40 +43,159 @@ auth_router = APIRouter(tags=["Authentication"])
 async def login_for_access_token(
     request: Request,
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_db),
 ):
     """Authenticate a user and return a JWT access token"""
+    await check_login_rate(request.client.host, form_data.username)  # type: ignore
     user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
+        LOGIN_FAILURE.inc()
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
         )
-    access_token = create_access_token(data={"sub": user.username})
-    create_session(access_token, db, request.client.host)  # type: ignore
-    return {"access_token": access_token, "token_type": "bearer"}
+    sid = new_session_id()
+    data = {"sub": user.username, "sid": sid}
+    if STATELESS_TOKENS:
+        data.update(await run_db(db, user_claims, user))
+    access_token = create_access_token(data=data)
+    refresh_token = new_refresh_token(sid) if REFRESH_TOKEN_EXPIRATION_TIME > 0 else None
+    LOGIN_SUCCESS.inc()
+    await create_session(
+        access_token,
+        db,
+        request.client.host,  # type: ignore
+        request.headers.get("user-agent", ""),
+        refresh_token,
+    )
+    response = {"access_token": access_token, "token_type": "bearer"}
+    if refresh_token is not None:
+        response["refresh_token"] = refresh_token
+    return response
+
+
+@auth_router.post("/token/refresh", tags=["Authentication"])
+async def refresh_access_token(body: TokenRefresh, db: AnySession = Depends(get_db)):
+    """Exchange a refresh token for a new JWT access token and a new refresh token"""
+    access_token, refresh_token = await refresh_session(db, body.refresh_token)
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+    }
 
 
 @auth_router.post(f"/logout", tags=["Authentication"], status_code=status.HTTP_200_OK)
-async def logout(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def logout(token: str = Depends(oauth2_scheme), db: AnySession = Depends(get_db)):
     """Logout a user and blacklisting their JWT access token"""
     try:
-        blacklist_token(token, db)
+        await blacklist_token(token, db)
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_406_NOT_ACCEPTABLE,
             detail="Invalid JWT token",
         )
+    token_cache.invalidate(token)
+    claims = jwt.get_unverified_claims(token)
+    if "sid" in claims:
+        await end_sessions(db, claims["sub"], [claims["sid"]])
     return {"detail": "Successfully logged out"}
 
 
+@auth_router.get("/sessions", tags=["Authentication"], response_model=List[SessionInfo])
+async def list_own_sessions(
+    token: str = Depends(oauth2_scheme),
+    user: User = Depends(authenticated),
+    db: AnySession = Depends(get_db),
+):
+    """List the active sessions of the current user"""
+    current_sid = jwt.get_unverified_claims(token).get("sid")
+    sessions = await replica_router.read(
+        db,
+        lambda read_db: session_store.list_sessions(read_db, user.username),  # type: ignore
+        user.username,  # type: ignore
+        retry=lambda sessions: False,
+    )
+    for session in sessions:
+        session.current = session.sid == current_sid
+    return sessions
+
+
+@auth_router.delete(
+    "/sessions/{sid}", tags=["Authentication"], response_model=SessionInfo
+)
+async def revoke_own_session(
+    sid: str,
+    user: User = Depends(authenticated),
+    db: AnySession = Depends(get_db),
+):
+    """Revoke one of the current user's sessions, signing out the device using it"""
+    sessions = await end_sessions(db, user.username, [sid])  # type: ignore
+    if not sessions:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Session not found",
+        )
+    return sessions[0]
+
+
+@auth_router.get("/.well-known/jwks.json", tags=["Authentication"])
+async def jwks(response: Response):
+    """Return the public keys used to sign JWT access tokens"""
+    response.headers["Cache-Control"] = "public, max-age=300"
+    if keyring is None:
+        return {"keys": []}
+    return keyring.jwks()
+
+
 user_router = APIRouter(tags=["Users"])
+
+
+def _get_existing_user(db: Session, username: str) -> User:
+    """Returns the user with the username or raises 404."""
+    existing_user = get_user_by_username(db, username)
+    if not existing_user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found",
+        )
+    return existing_user
+
+
+def _loaded(user: User) -> User:
+    """Loads the user's attributes and privileges, so it serializes outside the session."""
+    user.privileges
+    return user
+
+
+async def _update_user(username: str, new_userinfo: UserUpdate, db: AnySession):
+    """Updates a user's information."""
+
+    hashed_password = None
+    if new_userinfo.password != "":
+        hashed_password = await password_hasher.hash(new_userinfo.password)
+
+    def _update(db: Session):
+        existing_user = _get_existing_user(db, username)
+        existing_user.first_name = new_userinfo.first_name  # type: ignore
+        existing_user.last_name = new_userinfo.last_name  # type: ignore
+        existing_user.email = new_userinfo.email  # type: ignore
+        if hashed_password is not None:
+            existing_user.hashed_password = hashed_password  # type: ignore
+        db.commit()
+        return _loaded(existing_user)
+
+    existing_user = await run_db(db, _update)
+    token_cache.invalidate_user(username)
+    replica_router.note_write(username)
+    return existing_user
+
 if ALLOW_SELF_REGISTRATION:
 
     @user_router.post("/users/create")
     async def register_user_self_signup(new_user: UserCreate):
         """Register a new user"""
-        register_user(new_user)
+        await register_user(new_user)
         return {"detail": "user successfully registered"}
 
 else:
@@ -66,12 +206,21 @@ else:
         _: User = Depends(is_superuser),
     ):
         """Register a new user"""
-        register_user(new_user)
+        await register_user(new_user)
         return {"detail": "user successfully registered"}
 
 
+@user_router.post("/users/bulk/create", response_model=List[BulkResult])
+async def register_users_in_bulk(
+    new_users: List[UserCreate],
+    _: User = Depends(is_superuser),
+):
+    """Register a batch of users and return the result of each"""
+    return await register_users(new_users)
+
+
 @user_router.get("/users/me", response_model=UserRead)
-async def get_user(user: User = Depends(authenticated), db: Session = Depends(get_db)):
+async def get_user(user: User = Depends(authenticated), db: AnySession = Depends(get_db)):
     """Return the current user"""
     return user
 
@@ -82,25 +231,11 @@ if ALLOW_SELF_REGISTRATION:
     async def update_user(
         username: str,
         new_userinfo: UserUpdate,
-        db: Session = Depends(get_db),
+        db: AnySession = Depends(get_db),
         user: User = Depends(authenticated),
     ):
         """Update a user's information"""
-        existing_user = db.query(User).filter(
-            User.username == username).first()
-        if not existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found",
-            )
-        existing_user.first_name = new_userinfo.first_name  # type: ignore
-        existing_user.last_name = new_userinfo.last_name  # type: ignore
-        existing_user.email = new_userinfo.email  # type: ignore
-        if new_userinfo.password != "":
-            existing_user.hashed_password = pwd_context.hash(
-                new_userinfo.password)  # type: ignore
-        db.commit()
-        return existing_user
+        return await _update_user(username, new_userinfo, db)
 
 else:
 
@@ -108,56 +243,46 @@ else:
     async def update_user(
         username: str,
         new_userinfo: UserUpdate,
-        db: Session = Depends(get_db),
+        db: AnySession = Depends(get_db),
         user: User = Depends(is_superuser),
     ):
         """Update a user's information"""
-        existing_user = db.query(User).filter(
-            User.username == username).first()
-        if not existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found",
-            )
-        existing_user.first_name = new_userinfo.first_name  # type: ignore
-        existing_user.last_name = new_userinfo.last_name  # type: ignore
-        existing_user.email = new_userinfo.email  # type: ignore
-        if new_userinfo.password != "":
-            existing_user.hashed_password = pwd_context.hash(
-                new_userinfo.password)  # type: ignore
-        db.commit()
-        return existing_user
+        return await _update_user(username, new_userinfo, db)
 
 
 @user_router.post("/users/promote/{username}", response_model=UserRead)
 async def promote_user(
-    username: str, db: Session = Depends(get_db), user: User = Depends(is_superuser)
+    username: str, db: AnySession = Depends(get_db), user: User = Depends(is_superuser)
 ):
     """Promote a user to superuser"""
-    existing_user = db.query(User).filter(User.username == username).first()
-    if not existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found",
-        )
-    existing_user.is_superuser = True  # type: ignore
-    db.commit()
+
+    def _set_superuser(db: Session):
+        existing_user = _get_existing_user(db, username)
+        existing_user.is_superuser = True  # type: ignore
+        db.commit()
+        return _loaded(existing_user)
+
+    existing_user = await run_db(db, _set_superuser)
+    token_cache.invalidate_user(username)
+    replica_router.note_write(username)
     return existing_user
 
 
 @user_router.delete("/users/demote/{username}", response_model=UserRead)
 async def demote_user(
-    username: str, db: Session = Depends(get_db), user: User = Depends(is_superuser)
+    username: str, db: AnySession = Depends(get_db), user: User = Depends(is_superuser)
 ):
     """Demote a user to normal user"""
-    existing_user = db.query(User).filter(User.username == username).first()
-    if not existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found",
-        )
-    existing_user.is_superuser = False  # type: ignore
-    db.commit()
+
+    def _set_superuser(db: Session):
+        existing_user = _get_existing_user(db, username)
+        existing_user.is_superuser = False  # type: ignore
+        db.commit()
+        return _loaded(existing_user)
+
+    existing_user = await run_db(db, _set_superuser)
+    token_cache.invalidate_user(username)
+    replica_router.note_write(username)
     return existing_user
 
 
@@ -165,72 +290,190 @@ async def demote_user(
 async def add_privilege(
     username: str,
     privilege: str,
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_db),
     user: User = Depends(is_superuser),
 ):
     """Add a privilege to a user"""
-    existing_user = db.query(User).filter(User.username == username).first()
-    if not existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found",
-        )
-    new_privilege = UserPrivilege(
-        user_id=existing_user.id, privilege=privilege)
-    db.add(new_privilege)
-    db.commit()
+
+    def _add_privilege(db: Session):
+        existing_user = _get_existing_user(db, username)
+        new_privilege = UserPrivilege(
+            user_id=existing_user.id, privilege=privilege)
+        db.add(new_privilege)
+        db.commit()
+        return _loaded(existing_user)
+
+    existing_user = await run_db(db, _add_privilege)
+    token_cache.invalidate_user(username)
+    replica_router.note_write(username)
     return existing_user
 
 
+@user_router.post("/users/bulk/privilege/add", response_model=List[BulkResult])
+async def add_privileges_in_bulk(
+    grants: List[PrivilegeGrant],
+    _: User = Depends(is_superuser),
+):
+    """Add a batch of privileges to users and return the result of each"""
+    return await grant_privileges(grants)
+
+
 @user_router.post("/users/privilege/remove", response_model=UserRead)
 async def remove_privilege(
     username: str,
     privilege: str,
-    db: Session = Depends(get_db),
+    db: AnySession = Depends(get_db),
     user: User = Depends(is_superuser),
 ):
     """Remove a privilege from a user"""
-    existing_user = db.query(User).filter(User.username == username).first()
-    if not existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found",
-        )
-    existing_privilege = (
-        db.query(UserPrivilege)
-        .filter(UserPrivilege.user_id == existing_user.id)
-        .filter(UserPrivilege.privilege == privilege)
-        .first()
-    )
-    if not existing_privilege:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Privilege not found",
+
+    def _remove_privilege(db: Session):
+        existing_user = _get_existing_user(db, username)
+        existing_privilege = (
+            db.query(UserPrivilege)
+            .filter(UserPrivilege.user_id == existing_user.id)
+            .filter(UserPrivilege.privilege == privilege)
+            .first()
         )
-    db.delete(existing_privilege)
-    db.commit()
+        if not existing_privilege:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Privilege not found",
+            )
+        db.delete(existing_privilege)
+        db.commit()
+        return _loaded(existing_user)
+
+    existing_user = await run_db(db, _remove_privilege)
+    token_cache.invalidate_user(username)
+    replica_router.note_write(username)
     return existing_user
 
 
 @user_router.delete("/users/delete/{username}", response_model=UserRead)
 async def delete_user(
-    username: str, db: Session = Depends(get_db), user: User = Depends(is_superuser)
+    username: str, db: AnySession = Depends(get_db), user: User = Depends(is_superuser)
 ):
     """Delete a user"""
-    existing_user = db.query(User).filter(User.username == username).first()
-    if not existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found",
-        )
-    db.delete(existing_user)
-    db.commit()
+
+    def _delete_user(db: Session):
+        existing_user = _loaded(_get_existing_user(db, username))
+        db.delete(existing_user)
+        db.commit()
+        return existing_user
+
+    await end_sessions(db, username)
+    existing_user = await run_db(db, _delete_user)
+    token_cache.invalidate_user(username)
+    replica_router.note_write(username)
+    username_cache.put(username, False)
     return existing_user
 
 
+@user_router.get("/users/sessions/{username}", response_model=List[SessionInfo])
+async def list_user_sessions(
+    username: str, db: AnySession = Depends(get_db), user: User = Depends(is_superuser)
+):
+    """List the active sessions of a user"""
+    return await replica_router.read(
+        db,
+        lambda read_db: session_store.list_sessions(read_db, username),
+        username,
+        retry=lambda sessions: False,
+    )
+
+
+@user_router.delete("/users/sessions/{username}", response_model=List[SessionInfo])
+async def revoke_user_sessions(
+    username: str,
+    sid: Optional[str] = Query(None, description="Only revoke the session with this id"),
+    db: AnySession = Depends(get_db),
+    user: User = Depends(is_superuser),
+):
+    """Revoke all sessions of a user, or only the one with the given id"""
+    return await end_sessions(db, username, [sid] if sid is not None else None)
+
+
+def _query_users(db: Session, privilege: Optional[str], superuser: Optional[bool]):
+    """Returns the query of users matching the filters, with privileges eagerly loaded."""
+    query = db.query(User).options(selectinload(User.privileges))
+    if privilege is not None:
+        query = query.filter(User.privileges.any(UserPrivilege.privilege == privilege))
+    if superuser is not None:
+        query = query.filter(User.is_superuser == superuser)
+    return query
+
+
+def _get_users_page(
+    db: Session,
+    cursor: Optional[int],
+    limit: int,
+    privilege: Optional[str],
+    superuser: Optional[bool],
+) -> List[User]:
+    """Returns up to limit users with an id greater than the cursor, ordered by id."""
+    query = _query_users(db, privilege, superuser)
+    if cursor is not None:
+        query = query.filter(User.id > cursor)
+    return query.order_by(User.id).limit(limit).all()
+
+
+async def _stream_users(
+    limit: int, privilege: Optional[str], superuser: Optional[bool]
+) -> AsyncIterator[str]:
+    """Yields every matching user as a NDJSON line, loading one page at a time."""
+    cursor = None
+    async with open_db() as primary_db, replica_router.read_db(primary_db) as db:
+        while True:
+            users = await run_db(db, _get_users_page, cursor, limit, privilege, superuser)
+            for user in users:
+                yield UserRead.model_validate(user, from_attributes=True).model_dump_json() + "\n"
+            if len(users) < limit:
+                break
+            cursor = users[-1].id
+            db.expunge_all()
+
+
 @user_router.get("/users/all", response_model=list[UserRead])
 async def get_all_users(
-    db: Session = Depends(get_db), user: User = Depends(is_superuser)
+    response: Response,
+    cursor: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    privilege: Optional[str] = None,
+    superuser: Optional[bool] = Query(None, alias="is_superuser"),
+    stream: bool = False,
+    db: AnySession = Depends(get_read_db),
+    user: User = Depends(is_superuser),
 ):
-    """Get all users"""
-    return db.query(User).all()
+    """Get all users, optionally filtered by privilege and superuser flag.
+
+    Users are returned in pages of `limit`, ordered by id. When more users may follow,
+    the `X-Next-Cursor` header holds the cursor of the next page. With `stream=true`
+    every matching user is streamed as NDJSON instead, one page at a time.
+    """
+    if stream:
+        return StreamingResponse(
+            _stream_users(limit, privilege, superuser),
+            media_type="application/x-ndjson",
+        )
+    users = await run_db(db, _get_users_page, cursor, limit, privilege, superuser)
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = str(users[-1].id)
+    return users
+
+
+metrics_router = APIRouter(tags=["Metrics"])
+
+
+@metrics_router.get(METRICS_URL, response_class=PlainTextResponse)
+async def get_metrics():
+    """Return all metrics in the Prometheus text exposition format"""
+    return PlainTextResponse(
+        registry.expose(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@metrics_router.get(f"{METRICS_URL}/pool")
+async def get_pool_metrics():
+    """Return the database connection pool metrics"""
+    return pool_metrics.snapshot(getattr(Engine, "sync_engine", Engine).pool)
@@ -1,4 +1,5 @@
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 
 from pydantic import BaseModel, EmailStr
 
@@ -39,12 +40,47 @@ class UserUpdate(BaseModel):
     email: EmailStr
     password: str
 
+
+class PrivilegeGrant(BaseModel):
+    """Schemas for grant a privilege to a user."""
+
+    username: str
+    privilege: str
+
+
+class BulkResult(BaseModel):
+    """Schemas for the result of one item of a bulk request."""
+
+    index: int
+    username: str
+    status: str
+    detail: Optional[str] = None
+
+
+class SessionInfo(BaseModel):
+    """Schemas for an active session of a user."""
+
+    sid: str
+    username: str
+    client: str
+    user_agent: str
+    created_at: datetime
+    exp: datetime
+    current: bool = False
+
+
 class UserDelete(BaseModel):
     """Schemas for delete user."""
 
     username: str
 
 
+class TokenRefresh(BaseModel):
+    """Schemas for exchange a refresh token."""
+
+    refresh_token: str
+
+
 class BearToken(BaseModel):
     """Schemas for Bear Token information."""
 
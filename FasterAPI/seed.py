@@ -0,0 +1,204 @@
+import csv
+import json
+import os
+import pickle
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from . import logger
+from .cache import username_cache
+from .essentials import open_db, run_db
+from .hashing import password_hasher
+from .models import User
+from .schemas import UserCreate
+
+# users queued by create_user/create_superuser, imported and removed on startup
+BOOTSTRAP_FILE = ".seed.jsonl"
+# bootstrap files written by older versions
+LEGACY_BOOTSTRAP_FILES = (".superuser", ".users")
+
+
+@dataclass
+class SeedReport:
+    """Progress of a seed import."""
+
+    processed: int = 0
+    created: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+
+def append_seed(users: List[UserCreate], path: str = BOOTSTRAP_FILE):
+    """Appends users to a JSONL seed file, one line each, without rewriting the file."""
+    with open(path, "a", encoding="utf-8") as f:
+        for user in users:
+            f.write(user.model_dump_json() + "\n")
+
+
+def _read_records(
+    path: str, offset: int
+) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """Yields (end offset, record, error) for each line after the offset."""
+    is_csv = path.endswith(".csv")
+    with open(path, "rb") as f:
+        header: List[str] = []
+        if is_csv:
+            header = next(csv.reader([f.readline().decode("utf-8")]))
+            offset = max(offset, f.tell())
+        f.seek(offset)
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            text = line.decode("utf-8").strip()
+            if not text:
+                continue
+            try:
+                if is_csv:
+                    record = dict(zip(header, next(csv.reader([text]))))
+                else:
+                    record = json.loads(text)
+                yield f.tell(), record, None
+            except (ValueError, StopIteration) as e:
+                yield f.tell(), None, str(e)
+
+
+def _parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+
+def _existing_usernames(db: Session, usernames: List[str]) -> List[str]:
+    return [
+        username
+        for (username,) in db.query(User.username).filter(User.username.in_(usernames))
+    ]
+
+
+async def import_seed(
+    path: str,
+    chunk_size: int = 500,
+    remove: bool = False,
+    progress: Optional[Callable[[SeedReport], None]] = None,
+) -> SeedReport:
+    """Imports users from a JSONL or CSV seed file in chunked transactions.
+
+    Each record holds the user fields and either "password" or a pre-hashed
+    "hashed_password". Users that already exist are skipped before any hashing, and
+    the position of the last committed chunk is kept in "<path>.offset", so an
+    interrupted import resumes where it stopped and appended records are picked up by
+    the next import. CSV files need a header line and one record per line.
+
+    Args:
+        path (str): the seed file.
+        chunk_size (int, optional): the number of records per transaction. Defaults to 500.
+        remove (bool, optional): remove the file once fully imported. Defaults to False.
+        progress (Optional[Callable[[SeedReport], None]], optional): called after each chunk. Defaults to None.
+
+    Returns:
+        SeedReport: returns the counts of processed, created, skipped and failed records.
+    """
+    report = SeedReport()
+    if not os.path.exists(path):
+        return report
+    offset_path = f"{path}.offset"
+    offset = 0
+    if os.path.exists(offset_path):
+        with open(offset_path, "r") as f:
+            offset = int(f.read().strip() or 0)
+        if offset > os.path.getsize(path):
+            offset = 0
+
+    async def _import_chunk(chunk: List[Dict], end: int):
+        async with open_db() as db:
+            existing = set(
+                await run_db(
+                    db, _existing_usernames, [record["username"] for record in chunk]
+                )
+            )
+            new_records: Dict[str, Dict] = {}
+            for record in chunk:
+                if record["username"] in existing or record["username"] in new_records:
+                    report.skipped += 1
+                else:
+                    new_records[record["username"]] = record
+            to_hash = [r for r in new_records.values() if not r.get("hashed_password")]
+            hashed_passwords = await password_hasher.hash_many(
+                [str(record["password"]) for record in to_hash]
+            )
+            for record, hashed_password in zip(to_hash, hashed_passwords):
+                record["hashed_password"] = hashed_password
+
+            def _insert_users(db: Session):
+                if new_records:
+                    db.execute(
+                        insert(User),
+                        [
+                            {
+                                "username": record["username"],
+                                "hashed_password": record["hashed_password"],
+                                "first_name": record.get("first_name", ""),
+                                "last_name": record.get("last_name", ""),
+                                "email": record.get("email", ""),
+                                "is_superuser": _parse_bool(
+                                    record.get("is_superuser", False)
+                                ),
+                            }
+                            for record in new_records.values()
+                        ],
+                    )
+                db.commit()
+
+            await run_db(db, _insert_users)
+        for username in new_records:
+            username_cache.put(username, True)
+        report.created += len(new_records)
+        report.processed += len(chunk)
+        with open(offset_path, "w") as f:
+            f.write(str(end))
+        logger.info(
+            f"Seed {path}: {report.processed} processed, {report.created} created, "
+            f"{report.skipped} skipped, {report.failed} failed."
+        )
+        if progress is not None:
+            progress(report)
+
+    chunk: List[Dict] = []
+    end = offset
+    for end, record, error in _read_records(path, offset):
+        if (
+            record is None
+            or "username" not in record
+            or not (record.get("password") or record.get("hashed_password"))
+        ):
+            report.failed += 1
+            logger.warning(f"Seed {path}: skipping invalid record: {error or record}")
+            continue
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            await _import_chunk(chunk, end)
+            chunk = []
+    if chunk or end != offset:
+        await _import_chunk(chunk, end)
+    if remove:
+        os.remove(path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+    return report
+
+
+def migrate_legacy_bootstrap(path: str = BOOTSTRAP_FILE):
+    """Moves users queued in the pickle files of older versions into the seed file."""
+    for legacy_path in LEGACY_BOOTSTRAP_FILES:
+        try:
+            with open(legacy_path, "rb") as f:
+                users: List[UserCreate] = pickle.load(f)
+        except FileNotFoundError:
+            continue
+        append_seed(users, path)
+        os.remove(legacy_path)
+        logger.debug(f"Moved {len(users)} users from {legacy_path} to {path}.")
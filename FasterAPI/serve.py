@@ -0,0 +1,209 @@
+"""Production launcher running the application in several worker processes.
+
+Run with `python -m FasterAPI.serve`, or call `serve()` from a main script.
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from multiprocessing.context import SpawnProcess
+from typing import Any, Dict, List, Optional
+
+from . import logger
+from .settings import Settings, load_settings
+
+# seconds a worker must stay up before its exit is treated as a crash loop
+_MIN_WORKER_UPTIME = 5
+
+
+def _run_setup(settings: Settings):
+    """Migrates the database and imports the seeds, in a process of its own."""
+    import asyncio
+
+    from .app import setup_database
+
+    asyncio.run(setup_database(settings))
+
+
+def _run_worker(settings: Settings, options: Dict[str, Any], sock: socket.socket):
+    """Builds the application and serves it on the shared socket, in a worker process."""
+    import uvicorn
+
+    from .app import create_app
+
+    config = uvicorn.Config(create_app(settings), **options)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Launcher:
+    """Runs one worker process per core on a shared listening socket.
+
+    Workers are started with the spawn method, so each one opens its own database
+    pool, hashing pool and store connections instead of inheriting them. The database
+    is migrated and seeded once, before any worker starts, and only the first worker
+    runs the singleton jobs, a worker that dies is replaced with the same role. On
+    SIGTERM or SIGINT every worker stops accepting connections, lets open requests
+    finish for up to graceful_timeout seconds and runs its shutdown, then any worker
+    still running is killed.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        workers: int,
+        graceful_timeout: float,
+        options: Dict[str, Any],
+    ):
+        self.settings = settings
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.options = options
+        self.processes: List[Optional[SpawnProcess]] = [None] * workers
+        self._started_at: List[float] = [0.0] * workers
+        self._context = multiprocessing.get_context("spawn")
+        self._should_exit = False
+
+    def run(self):
+        """Starts the workers and supervises them until asked to stop."""
+        import uvicorn
+
+        self._setup_database()
+        # the socket is bound once here and shared by every worker
+        sock = uvicorn.Config(app=None, **self.options).bind_socket()  # type: ignore
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._handle_exit)
+        logger.info(f"Starting {self.workers} workers, parent pid {os.getpid()}.")
+        try:
+            for index in range(self.workers):
+                self._start(index, sock)
+            while not self._should_exit:
+                time.sleep(0.5)
+                for index, process in enumerate(self.processes):
+                    if process is None or process.is_alive() or self._should_exit:
+                        continue
+                    logger.warning(
+                        f"Worker {index} (pid {process.pid}) exited with code "
+                        f"{process.exitcode}, restarting it."
+                    )
+                    if time.monotonic() - self._started_at[index] < _MIN_WORKER_UPTIME:
+                        time.sleep(1)
+                    self._start(index, sock)
+        finally:
+            self._stop()
+            sock.close()
+
+    def _setup_database(self):
+        if not self.settings.DATABASE_SETUP:
+            return
+        # run in a child so the parent never opens the database or imports the app
+        process = self._context.Process(
+            target=_run_setup, name="FasterAPI-setup", args=(self.settings,)
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(
+                f"Database setup failed with exit code {process.exitcode}."
+            )
+
+    def _worker_settings(self, index: int) -> Settings:
+        update: Dict[str, Any] = {"DATABASE_SETUP": False}
+        if index != 0:
+            update["SINGLETON_JOBS"] = False
+        return self.settings.model_copy(update=update)
+
+    def _start(self, index: int, sock: socket.socket):
+        process = self._context.Process(
+            target=_run_worker,
+            name=f"FasterAPI-worker-{index}",
+            args=(self._worker_settings(index), self.options, sock),
+        )
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logger.debug(f"Worker {index} started with pid {process.pid}.")
+
+    def _handle_exit(self, signum, frame):
+        self._should_exit = True
+
+    def _stop(self):
+        processes = [p for p in self.processes if p is not None and p.is_alive()]
+        logger.info(f"Stopping {len(processes)} workers.")
+        for process in processes:
+            process.terminate()
+        # workers get the graceful timeout to drain plus a margin for their shutdown
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker pid {process.pid} did not stop, killing it.")
+                process.kill()
+                process.join()
+
+
+def serve(
+    settings: Optional[Settings] = None,
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+    workers: Optional[int] = None,
+    graceful_timeout: Optional[float] = None,
+    **uvicorn_options,
+):
+    """Serves the application with several worker processes.
+
+    Args:
+        settings (Optional[Settings], optional): the settings, loaded from the configuration files and the environment if None. Defaults to None.
+        host (Optional[str], optional): the address to listen on. Defaults to HOST.
+        port (Optional[int], optional): the port to listen on. Defaults to PORT.
+        workers (Optional[int], optional): the number of worker processes. Defaults to WORKERS, or the number of cores.
+        graceful_timeout (Optional[float], optional): the seconds open requests get to finish on shutdown. Defaults to GRACEFUL_TIMEOUT.
+        **uvicorn_options: passed to uvicorn.Config, e.g. ssl_keyfile and ssl_certfile.
+    """
+    if settings is None:
+        settings = load_settings()
+    if graceful_timeout is None:
+        graceful_timeout = settings.GRACEFUL_TIMEOUT
+    options = {
+        "host": host or settings.HOST,
+        "port": settings.PORT if port is None else port,
+        "timeout_graceful_shutdown": math.ceil(graceful_timeout),
+        **uvicorn_options,
+    }
+    Launcher(
+        settings,
+        workers or settings.WORKERS or os.cpu_count() or 1,
+        graceful_timeout,
+        options,
+    ).run()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m FasterAPI.serve")
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--graceful-timeout", type=float)
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--ssl-keyfile")
+    parser.add_argument("--ssl-certfile")
+    args = parser.parse_args(argv)
+    uvicorn_options: Dict[str, Any] = {"log_level": args.log_level}
+    if args.ssl_keyfile:
+        uvicorn_options["ssl_keyfile"] = args.ssl_keyfile
+    if args.ssl_certfile:
+        uvicorn_options["ssl_certfile"] = args.ssl_certfile
+    serve(
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        graceful_timeout=args.graceful_timeout,
+        **uvicorn_options,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import os
+import secrets
+import sys
+from typing import Any, Dict, List, Literal, Optional, Union
+
+import yaml
+from pydantic import (
+    AliasChoices,
+    BaseModel,
+    ConfigDict,
+    Field,
+    field_validator,
+    model_validator,
+)
+
+from . import logger
+
+
+class Settings(BaseModel):
+    """All configuration of FasterAPI, validated.
+
+    Every key of auth_config.yaml and meta_config.yaml is a field. Keys this model does
+    not know are kept as extra fields, so applications can read their own keys from it.
+    """
+
+    model_config = ConfigDict(extra="allow", frozen=True)
+
+    # database
+    SQLALCHEMY_DATABASE_URL: str = "sqlite:///dev.db"
+    ASYNC_DATABASE: bool = False
+    POOL_SIZE: Optional[int] = Field(default=None, ge=0)
+    MAX_OVERFLOW: Optional[int] = None
+    POOL_TIMEOUT: Optional[float] = Field(default=None, ge=0)
+    POOL_RECYCLE: Optional[int] = None
+    POOL_PRE_PING: bool = False
+
+    # tokens and sessions
+    SECRET_KEY: str = Field(default_factory=lambda: secrets.token_hex(32))
+    ALGORITHM: str = "HS256"
+    KEY_DIRECTORY: str = "./keys"
+    KEY_ROTATION_INTERVAL: float = Field(default=168, ge=0)
+    TOKEN_URL: str = "login"
+    TOKEN_EXPIRATION_TIME: int = Field(default=15, gt=0)
+    ALLOW_MULTI_SESSIONS: bool = True
+    REFRESH_TOKEN_EXPIRATION_TIME: int = Field(default=10080, ge=0)
+    MAX_SESSIONS_PER_USER: int = Field(default=10, ge=0)
+    ALLOW_SELF_REGISTRATION: bool = False
+    STATELESS_TOKENS: bool = False
+    REVOCATION_INDEX: bool = True
+    REVOCATION_INDEX_CAPACITY: int = Field(default=100000, gt=0)
+    REVOCATION_SYNC_INTERVAL: float = Field(default=5, gt=0)
+    SESSION_STORE: Literal["sql", "redis", "memory"] = "sql"
+    SESSION_STORE_URL: str = "redis://localhost:6379/0"
+    SESSION_STORE_POOL_SIZE: int = Field(default=10, gt=0)
+    SESSION_STORE_PREFIX: str = "fasterapi:"
+
+    # read replicas
+    READ_REPLICA_URLS: List[str] = []
+    REPLICA_MAX_LAG: float = Field(default=5, gt=0)
+    REPLICA_CHECK_INTERVAL: float = Field(default=2, gt=0)
+    READ_YOUR_WRITES_WINDOW: float = Field(default=10, ge=0)
+
+    # login protection and password hashing
+    LOGIN_RATE_LIMIT_PER_IP: int = Field(default=20, ge=0)
+    LOGIN_RATE_LIMIT_PER_USERNAME: int = Field(default=5, ge=0)
+    LOGIN_RATE_LIMIT_PERIOD: float = Field(default=60, gt=0)
+    RATE_LIMIT_BACKEND: Literal["memory", "redis"] = "memory"
+    # defaults to SESSION_STORE_URL
+    RATE_LIMIT_URL: Optional[str] = None
+    TOKEN_CACHE_SIZE: int = Field(default=1024, ge=0)
+    USERNAME_CACHE_SIZE: int = Field(default=100000, ge=0)
+    USERNAME_CACHE_TTL: float = Field(default=30, ge=0)
+    HASH_EXECUTOR: Literal["thread", "process"] = "thread"
+    HASH_WORKERS: int = Field(default_factory=lambda: min(4, os.cpu_count() or 1), gt=0)
+    HASH_QUEUE_SIZE: int = Field(default=64, ge=0)
+    PASSWORD_SCHEMES: List[str] = Field(default=["bcrypt"], min_length=1)
+    BCRYPT_ROUNDS: int = Field(default=12, ge=4, le=31)
+    ARGON2_TIME_COST: int = Field(default=2, ge=1)
+    ARGON2_MEMORY_COST: int = Field(default=102400, ge=8)
+    ARGON2_PARALLELISM: int = Field(default=8, ge=1)
+
+    # pre-generated private keys for certificate issuance
+    KEY_POOL_SIZE: int = Field(default=0, ge=0)
+    KEY_POOL_KEY_TYPE: Literal["rsa", "ec", "ed25519"] = "rsa"
+    # defaults to 2048 for RSA and 256 for EC
+    KEY_POOL_KEY_SIZE: Optional[int] = Field(default=None, gt=0)
+    KEY_POOL_WORKERS: int = Field(default_factory=lambda: min(2, os.cpu_count() or 1), gt=0)
+    KEY_POOL_EXECUTOR: Literal["thread", "process"] = "thread"
+    KEY_POOL_SPILL_DIRECTORY: Optional[str] = None
+    KEY_POOL_SPILL_SIZE: int = Field(default=1000, ge=0)
+    KEY_POOL_SPILL_PASSPHRASE: Optional[str] = None
+
+    # maintenance and seeding
+    # defaults to the token expiration time
+    REAPER_INTERVAL: Optional[float] = Field(default=None, gt=0)
+    REAPER_JITTER: float = Field(default=0.1, ge=0, lt=1)
+    REAPER_BATCH_SIZE: int = Field(default=1000, gt=0)
+    SEED_FILE: Optional[str] = None
+    SEED_CHUNK_SIZE: int = Field(default=500, gt=0)
+    SCHEDULER: bool = True
+    # run the jobs only one worker per host needs: the reaper, key rotation and the
+    # scheduler, the launcher enables it in its first worker only
+    SINGLETON_JOBS: bool = True
+    # migrate and create the tables and import the seeds on startup, the launcher does
+    # it once before starting the workers and turns it off in them
+    DATABASE_SETUP: bool = True
+
+    # launcher
+    HOST: str = "127.0.0.1"
+    PORT: int = Field(default=8000, ge=0, le=65535)
+    # defaults to the number of cores
+    WORKERS: Optional[int] = Field(default=None, gt=0)
+    GRACEFUL_TIMEOUT: float = Field(default=30, ge=0)
+
+    # CORS
+    ALLOWED_ORIGINS: List[str] = ["*"]
+    ALLOW_CREDENTIALS: bool = True
+    ALLOW_METHODS: List[str] = Field(
+        default=["*"], validation_alias=AliasChoices("ALLOW_METHODS", "ALLOWED_METHODS")
+    )
+    ALLOW_HEADERS: List[str] = Field(
+        default=["*"], validation_alias=AliasChoices("ALLOW_HEADERS", "ALLOWED_HEADERS")
+    )
+
+    # application
+    DEBUG: bool = False
+    TITLE: str = "FasterAPI"
+    DESCRIPTION: str = "A FastAPI starter template with prebuilt JWT auth system."
+    VERSION: str = "0.0.1"
+    OPENAPI_URL: Optional[str] = "/openapi.json"
+    DOCS_URL: Optional[str] = "/docs"
+    REDOC_URL: Optional[str] = "/redoc"
+    TERMS_OF_SERVICE: Optional[str] = None
+    CONTACT: Optional[Union[Dict[str, str], str]] = None
+    SUMMARY: Optional[str] = None
+    METRICS: bool = True
+    METRICS_URL: str = "/metrics"
+
+    # tracing, requires the opentelemetry packages
+    TRACE: bool = False
+    SVC_NAME: str = "FasterAPI"
+    TRACE_ENDPOINT: str = "localhost:4317"
+    TRACE_EXPORT: Literal["batch", "simple"] = "batch"
+    TRACE_MAX_QUEUE_SIZE: int = Field(default=2048, gt=0)
+    TRACE_MAX_EXPORT_BATCH_SIZE: int = Field(default=512, gt=0)
+    TRACE_SCHEDULE_DELAY: float = Field(default=5000, ge=0)
+    TRACE_EXPORT_TIMEOUT: float = Field(default=30000, ge=0)
+    TRACE_SAMPLE_RATIO: float = Field(default=1.0, ge=0, le=1)
+
+    @field_validator(
+        "PASSWORD_SCHEMES",
+        "READ_REPLICA_URLS",
+        "ALLOWED_ORIGINS",
+        "ALLOW_METHODS",
+        "ALLOW_HEADERS",
+        mode="before",
+    )
+    @classmethod
+    def _split_list(cls, value: Any) -> Any:
+        # environment variables hold comma separated lists
+        if isinstance(value, str):
+            return [item.strip() for item in value.split(",") if item.strip()]
+        return value
+
+    @model_validator(mode="after")
+    def _check_hash_cost(self) -> "Settings":
+        if self.ARGON2_MEMORY_COST < 8 * self.ARGON2_PARALLELISM:
+            raise ValueError(
+                "ARGON2_MEMORY_COST must be at least 8 x ARGON2_PARALLELISM"
+            )
+        return self
+
+    @model_validator(mode="after")
+    def _check_key_pool_spill(self) -> "Settings":
+        if self.KEY_POOL_SPILL_DIRECTORY and not self.KEY_POOL_SPILL_PASSPHRASE:
+            raise ValueError(
+                "KEY_POOL_SPILL_PASSPHRASE is required with KEY_POOL_SPILL_DIRECTORY"
+            )
+        return self
+
+    @property
+    def rate_limit_url(self) -> str:
+        """The url of the redis rate limiter."""
+        return self.RATE_LIMIT_URL or self.SESSION_STORE_URL
+
+    @property
+    def reaper_interval(self) -> float:
+        """The seconds between runs of the reaper."""
+        if self.REAPER_INTERVAL is None:
+            return self.TOKEN_EXPIRATION_TIME * 60
+        return self.REAPER_INTERVAL
+
+
+def _read_yaml(path: str) -> Dict:
+    try:
+        with open(path, "r") as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        logger.debug(f"Configuration file {path} not found.")
+        return {}
+
+
+def load_settings(
+    config_path: str = "./auth_config.yaml",
+    meta_config_path: str = "./meta_config.yaml",
+    **overrides,
+) -> Settings:
+    """Loads the settings from the configuration files and the environment.
+
+    Environment variables take precedence over the files, and keyword overrides take
+    precedence over both.
+
+    Args:
+        config_path (str, optional): the auth configuration file. Defaults to "./auth_config.yaml".
+        meta_config_path (str, optional): the meta configuration file. Defaults to "./meta_config.yaml".
+
+    Returns:
+        Settings: returns the validated settings.
+    """
+    values: Dict[str, Any] = {**_read_yaml(meta_config_path), **_read_yaml(config_path)}
+    names = set(values)
+    for name, field in Settings.model_fields.items():
+        names.add(name)
+        if isinstance(field.validation_alias, AliasChoices):
+            names.update(str(choice) for choice in field.validation_alias.choices)
+    for name in names:
+        if name in os.environ:
+            values[name] = os.environ[name]
+    values.update(overrides)
+    return Settings(**values)
+
+
+_settings: Optional[Settings] = None
+# the role of a process, only read when the application is built, so they may still
+# change after FasterAPI.essentials is imported, e.g. by a main script in a spawned worker
+_ROLE_FIELDS = {"SINGLETON_JOBS", "DATABASE_SETUP"}
+
+
+def configure(settings: Settings):
+    """Makes the settings the ones FasterAPI runs with.
+
+    The settings are read once, when FasterAPI.essentials is first imported, so they
+    must be configured before that. Only SINGLETON_JOBS and DATABASE_SETUP may change
+    afterwards.
+    """
+    global _settings
+    if (
+        "FasterAPI.essentials" in sys.modules
+        and _settings is not None
+        and settings.model_dump(exclude=_ROLE_FIELDS)
+        != _settings.model_dump(exclude=_ROLE_FIELDS)
+    ):
+        raise RuntimeError(
+            "FasterAPI is already configured, settings can only be changed before "
+            "FasterAPI.essentials is imported."
+        )
+    _settings = settings
+
+
+def get_settings() -> Settings:
+    """Returns the configured settings, loading them on first use."""
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
@@ -0,0 +1,799 @@
+import asyncio
+import ssl
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple, Type, Union
+from urllib.parse import unquote, urlparse
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .essentials import (
+    SESSION_STORE,
+    SESSION_STORE_POOL_SIZE,
+    SESSION_STORE_PREFIX,
+    SESSION_STORE_URL,
+    TOKEN_EXPIRATION_TIME,
+    AnySession,
+    run_db,
+)
+from .models import ActiveSession, BlacklistedToken, MaintenanceLease
+from .schemas import SessionInfo
+
+# seconds of overlap between revocation index syncs, covers clock skew between workers
+REVOCATION_SYNC_OVERLAP = 5
+
+
+class SessionStore:
+    """Where active sessions and revoked tokens are kept.
+
+    Every method receives the request's database session, which backends that do not
+    store anything in the database simply ignore. Revocations are listed by an
+    increasing cursor so each worker can keep its revocation index in sync.
+    """
+
+    async def create_session(
+        self,
+        db: AnySession,
+        session: SessionInfo,
+        limit: int = 0,
+        refresh_hash: Optional[str] = None,
+    ) -> List[SessionInfo]:
+        """Records a new session and evicts the oldest sessions of the user beyond the limit.
+
+        Returns the evicted sessions, a limit of 0 means no limit. The digest of the
+        session's current refresh token, if any, is kept with it.
+        """
+        raise NotImplementedError
+
+    async def rotate_refresh_token(
+        self, db: AnySession, sid: str, presented_hash: str, new_hash: str
+    ) -> Optional[bool]:
+        """Replaces the session's refresh token digest if it matches the presented one.
+
+        Returns True if rotated, False if the session holds another digest, meaning
+        the presented token was already used, and None if there is no such session.
+        """
+        raise NotImplementedError
+
+    async def get_session(self, db: AnySession, sid: str) -> Optional[SessionInfo]:
+        """Returns the unexpired session with the id, or None."""
+        raise NotImplementedError
+
+    async def list_sessions(self, db: AnySession, username: str) -> List[SessionInfo]:
+        """Returns the unexpired sessions of the user, oldest first."""
+        raise NotImplementedError
+
+    async def delete_sessions(
+        self, db: AnySession, username: str, sids: Optional[List[str]] = None
+    ) -> List[SessionInfo]:
+        """Deletes the sessions of the user with the ids, or all of them, and returns them."""
+        raise NotImplementedError
+
+    async def revoke(self, db: AnySession, digest: str, exp: datetime):
+        """Records the token with the hex digest as revoked until exp."""
+        raise NotImplementedError
+
+    async def is_revoked(self, db: AnySession, digest: str) -> bool:
+        """Returns True if the token with the hex digest is revoked."""
+        raise NotImplementedError
+
+    async def revoked_since(
+        self, db: AnySession, cursor: float
+    ) -> List[Tuple[float, str, float]]:
+        """Returns (cursor, hex digest, exp timestamp) of unexpired tokens revoked after the cursor."""
+        raise NotImplementedError
+
+    async def acquire_lease(
+        self, db: AnySession, name: str, owner: str, ttl: timedelta
+    ) -> bool:
+        """Takes or renews the named lease for the owner, returns True if held."""
+        raise NotImplementedError
+
+    async def reap(self, db: AnySession, batch_size: int) -> Dict[str, int]:
+        """Deletes expired entries not expired by the backend itself, returns the counts per kind."""
+        raise NotImplementedError
+
+    async def counts(self, db: AnySession) -> Dict[str, int]:
+        """Returns the number of revoked tokens and sessions, where the backend can tell."""
+        raise NotImplementedError
+
+    async def close(self):
+        """Releases the connections of the store."""
+
+
+def acquire_lease(db: Session, name: str, owner: str, ttl: timedelta) -> bool:
+    """Takes or renews the named lease for the owner.
+
+    The lease is granted if it is free, expired or already held by the owner, so
+    exactly one worker across every process and replica sharing the database holds it
+    at a time. A holder that stops renewing loses the lease once the ttl runs out.
+
+    Args:
+        db (Session): the database session.
+        name (str): the name of the lease.
+        owner (str): the id of the worker asking for the lease.
+        ttl (timedelta): how long the lease is held without renewal.
+
+    Returns:
+        bool: returns True if the owner holds the lease.
+    """
+    now = datetime.now()
+    renewed = (
+        db.query(MaintenanceLease)
+        .filter(
+            MaintenanceLease.name == name,
+            or_(MaintenanceLease.owner == owner, MaintenanceLease.expires_at < now),
+        )
+        .update({"owner": owner, "expires_at": now + ttl}, synchronize_session=False)
+    )
+    if renewed:
+        db.commit()
+        return True
+    if db.get(MaintenanceLease, name) is not None:
+        db.rollback()
+        return False
+    db.add(MaintenanceLease(name=name, owner=owner, expires_at=now + ttl))
+    try:
+        db.commit()
+    except IntegrityError:
+        # another worker created the lease first
+        db.rollback()
+        return False
+    return True
+
+
+def _delete_expired_batch(
+    model: Union[Type[BlacklistedToken], Type[ActiveSession]], batch_size: int
+):
+    def _delete(db: Session) -> int:
+        ids = [
+            row_id
+            for (row_id,) in db.query(model.id)
+            .filter(model.exp < datetime.now())
+            .order_by(model.id)
+            .limit(batch_size)
+        ]
+        if ids:
+            db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        return len(ids)
+
+    return _delete
+
+
+def _session_info(row: ActiveSession) -> SessionInfo:
+    return SessionInfo(
+        sid=row.sid,
+        username=row.username,
+        client=row.client,
+        user_agent=row.user_agent,
+        created_at=row.created_at,
+        exp=row.exp,
+    )
+
+
+class SqlSessionStore(SessionStore):
+    """Keeps sessions and revocations in the application database."""
+
+    async def create_session(
+        self,
+        db: AnySession,
+        session: SessionInfo,
+        limit: int = 0,
+        refresh_hash: Optional[str] = None,
+    ) -> List[SessionInfo]:
+        def _create_session(db: Session) -> List[SessionInfo]:
+            db.add(
+                ActiveSession(
+                    **session.model_dump(exclude={"current"}),
+                    refresh_hash=refresh_hash,
+                )
+            )
+            db.flush()
+            evicted = []
+            if limit > 0:
+                evicted = (
+                    db.query(ActiveSession)
+                    .filter(ActiveSession.username == session.username)
+                    .order_by(ActiveSession.created_at.desc(), ActiveSession.id.desc())
+                    .offset(limit)
+                    .all()
+                )
+                for row in evicted:
+                    db.delete(row)
+            db.commit()
+            return [_session_info(row) for row in evicted]
+
+        return await run_db(db, _create_session)
+
+    async def rotate_refresh_token(
+        self, db: AnySession, sid: str, presented_hash: str, new_hash: str
+    ) -> Optional[bool]:
+        def _rotate_refresh_token(db: Session) -> Optional[bool]:
+            now = datetime.now()
+            # a conditional update, so concurrent refreshes cannot both succeed
+            rotated = (
+                db.query(ActiveSession)
+                .filter(ActiveSession.sid == sid)
+                .filter(ActiveSession.refresh_hash == presented_hash)
+                .filter(ActiveSession.exp >= now)
+                .update({"refresh_hash": new_hash}, synchronize_session=False)
+            )
+            db.commit()
+            if rotated:
+                return True
+            exists = (
+                db.query(ActiveSession.id)
+                .filter(ActiveSession.sid == sid)
+                .filter(ActiveSession.exp >= now)
+                .first()
+            )
+            return False if exists else None
+
+        return await run_db(db, _rotate_refresh_token)
+
+    async def get_session(self, db: AnySession, sid: str) -> Optional[SessionInfo]:
+        def _get_session(db: Session) -> Optional[SessionInfo]:
+            row = (
+                db.query(ActiveSession)
+                .filter(ActiveSession.sid == sid)
+                .filter(ActiveSession.exp >= datetime.now())
+                .first()
+            )
+            return _session_info(row) if row else None
+
+        return await run_db(db, _get_session)
+
+    async def list_sessions(self, db: AnySession, username: str) -> List[SessionInfo]:
+        def _list_sessions(db: Session) -> List[SessionInfo]:
+            return [
+                _session_info(row)
+                for row in db.query(ActiveSession)
+                .filter(ActiveSession.username == username)
+                .filter(ActiveSession.exp >= datetime.now())
+                .order_by(ActiveSession.created_at, ActiveSession.id)
+            ]
+
+        return await run_db(db, _list_sessions)
+
+    async def delete_sessions(
+        self, db: AnySession, username: str, sids: Optional[List[str]] = None
+    ) -> List[SessionInfo]:
+        def _delete_sessions(db: Session) -> List[SessionInfo]:
+            query = db.query(ActiveSession).filter(ActiveSession.username == username)
+            if sids is not None:
+                query = query.filter(ActiveSession.sid.in_(sids))
+            rows = query.all()
+            for row in rows:
+                db.delete(row)
+            db.commit()
+            return [_session_info(row) for row in rows]
+
+        return await run_db(db, _delete_sessions)
+
+    async def revoke(self, db: AnySession, digest: str, exp: datetime):
+        def _revoke(db: Session):
+            db.add(BlacklistedToken(token_hash=digest, exp=exp))
+            db.commit()
+
+        await run_db(db, _revoke)
+
+    async def is_revoked(self, db: AnySession, digest: str) -> bool:
+        def _is_revoked(db: Session) -> bool:
+            return (
+                db.query(BlacklistedToken.id)
+                .filter(BlacklistedToken.token_hash == digest)
+                .first()
+                is not None
+            )
+
+        return await run_db(db, _is_revoked)
+
+    async def revoked_since(
+        self, db: AnySession, cursor: float
+    ) -> List[Tuple[float, str, float]]:
+        def _revoked_since(db: Session):
+            return (
+                db.query(
+                    BlacklistedToken.id,
+                    BlacklistedToken.token_hash,
+                    BlacklistedToken.exp,
+                )
+                .filter(BlacklistedToken.id > cursor)
+                .filter(BlacklistedToken.exp >= datetime.now())
+                .all()
+            )
+
+        rows = await run_db(db, _revoked_since)
+        return [
+            (row_id, token_hash, exp.timestamp()) for row_id, token_hash, exp in rows
+        ]
+
+    async def acquire_lease(
+        self, db: AnySession, name: str, owner: str, ttl: timedelta
+    ) -> bool:
+        return await run_db(db, acquire_lease, name, owner, ttl)
+
+    async def reap(self, db: AnySession, batch_size: int) -> Dict[str, int]:
+        reclaimed = {}
+        for model in (BlacklistedToken, ActiveSession):
+            total = 0
+            while True:
+                deleted = await run_db(db, _delete_expired_batch(model, batch_size))
+                total += deleted
+                if deleted < batch_size:
+                    break
+                await asyncio.sleep(0)
+            reclaimed[model.__tablename__] = total
+        return reclaimed
+
+    async def counts(self, db: AnySession) -> Dict[str, int]:
+        def _counts(db: Session) -> Dict[str, int]:
+            return {
+                "blacklisted_tokens": db.query(BlacklistedToken).count(),
+                "active_sessions": db.query(ActiveSession)
+                .filter(ActiveSession.exp >= datetime.now())
+                .count(),
+            }
+
+        return await run_db(db, _counts)
+
+
+class MemorySessionStore(SessionStore):
+    """Keeps sessions and revocations in process memory, for tests and single-worker use."""
+
+    def __init__(self):
+        self._sessions: Dict[str, SessionInfo] = {}
+        self._refresh_hashes: Dict[str, Optional[str]] = {}
+        self._revoked: Dict[str, float] = {}
+        self._log: List[Tuple[int, str, float]] = []
+        self._sequence = 0
+        self._leases: Dict[str, Tuple[str, float]] = {}
+
+    async def create_session(
+        self,
+        db: AnySession,
+        session: SessionInfo,
+        limit: int = 0,
+        refresh_hash: Optional[str] = None,
+    ) -> List[SessionInfo]:
+        self._sessions[session.sid] = session
+        self._refresh_hashes[session.sid] = refresh_hash
+        if limit <= 0:
+            return []
+        sessions = await self.list_sessions(db, session.username)
+        evicted = sessions[: max(len(sessions) - limit, 0)]
+        for old_session in evicted:
+            self._forget(old_session.sid)
+        return evicted
+
+    async def rotate_refresh_token(
+        self, db: AnySession, sid: str, presented_hash: str, new_hash: str
+    ) -> Optional[bool]:
+        if await self.get_session(db, sid) is None:
+            return None
+        if self._refresh_hashes.get(sid) != presented_hash:
+            return False
+        self._refresh_hashes[sid] = new_hash
+        return True
+
+    def _forget(self, sid: str):
+        del self._sessions[sid]
+        self._refresh_hashes.pop(sid, None)
+
+    async def get_session(self, db: AnySession, sid: str) -> Optional[SessionInfo]:
+        session = self._sessions.get(sid)
+        if session is None or session.exp < datetime.now():
+            return None
+        return session
+
+    async def list_sessions(self, db: AnySession, username: str) -> List[SessionInfo]:
+        now = datetime.now()
+        return sorted(
+            (
+                session
+                for session in self._sessions.values()
+                if session.username == username and session.exp >= now
+            ),
+            key=lambda session: session.created_at,
+        )
+
+    async def delete_sessions(
+        self, db: AnySession, username: str, sids: Optional[List[str]] = None
+    ) -> List[SessionInfo]:
+        deleted = [
+            session
+            for session in self._sessions.values()
+            if session.username == username and (sids is None or session.sid in sids)
+        ]
+        for session in deleted:
+            self._forget(session.sid)
+        return deleted
+
+    async def revoke(self, db: AnySession, digest: str, exp: datetime):
+        self._sequence += 1
+        self._revoked[digest] = exp.timestamp()
+        self._log.append((self._sequence, digest, exp.timestamp()))
+
+    async def is_revoked(self, db: AnySession, digest: str) -> bool:
+        exp = self._revoked.get(digest)
+        return exp is not None and exp >= time.time()
+
+    async def revoked_since(
+        self, db: AnySession, cursor: float
+    ) -> List[Tuple[float, str, float]]:
+        now = time.time()
+        return [entry for entry in self._log if entry[0] > cursor and entry[2] >= now]
+
+    async def acquire_lease(
+        self, db: AnySession, name: str, owner: str, ttl: timedelta
+    ) -> bool:
+        now = time.time()
+        holder = self._leases.get(name)
+        if holder is not None and holder[0] != owner and holder[1] >= now:
+            return False
+        self._leases[name] = (owner, now + ttl.total_seconds())
+        return True
+
+    async def reap(self, db: AnySession, batch_size: int) -> Dict[str, int]:
+        now = time.time()
+        expired_tokens = [d for d, exp in self._revoked.items() if exp < now]
+        for digest in expired_tokens:
+            del self._revoked[digest]
+        self._log = [entry for entry in self._log if entry[2] >= now]
+        expired_sessions = [
+            sid
+            for sid, session in self._sessions.items()
+            if session.exp.timestamp() < now
+        ]
+        for sid in expired_sessions:
+            self._forget(sid)
+        return {
+            "blacklisted_tokens": len(expired_tokens),
+            "active_sessions": len(expired_sessions),
+        }
+
+    async def counts(self, db: AnySession) -> Dict[str, int]:
+        return {
+            "blacklisted_tokens": len(self._revoked),
+            "active_sessions": len(self._sessions),
+        }
+
+
+class RedisError(Exception):
+    """An error reply from a Redis-protocol server."""
+
+
+def _encode_command(args: Sequence) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed by the server.")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode()
+    if kind == b"-":
+        return RedisError(payload.decode())
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise RedisError(f"Unexpected reply {line!r}.")
+
+
+class RedisClient:
+    """A minimal asyncio client for the Redis protocol with a bounded connection pool.
+
+    Supports redis:// and rediss:// urls with an optional password and database
+    number. Commands sent together by `pipeline` share one round trip.
+    """
+
+    def __init__(self, url: str, pool_size: int = 10):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self.ssl = parsed.scheme == "rediss"
+        self.pool_size = pool_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, ssl=ssl.create_default_context() if self.ssl else None
+        )
+        handshake = []
+        if self.password is not None:
+            handshake.append(
+                ("AUTH", self.username, self.password)
+                if self.username
+                else ("AUTH", self.password)
+            )
+        if self.database:
+            handshake.append(("SELECT", self.database))
+        if handshake:
+            writer.write(b"".join(_encode_command(c) for c in handshake))
+            await writer.drain()
+            for _ in handshake:
+                reply = await _read_reply(reader)
+                if isinstance(reply, RedisError):
+                    writer.close()
+                    raise reply
+        return reader, writer
+
+    async def pipeline(self, commands: Sequence[Sequence]) -> List:
+        """Sends the commands in one write and returns their replies in order."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # connections cannot be shared between event loops
+            self._loop = loop
+            self._idle = []
+            self._slots = asyncio.Semaphore(self.pool_size)
+        async with self._slots:  # type: ignore
+            connection = self._idle.pop() if self._idle else await self._connect()
+            reader, writer = connection
+            try:
+                writer.write(b"".join(_encode_command(c) for c in commands))
+                await writer.drain()
+                replies = [await _read_reply(reader) for _ in commands]
+            except BaseException:
+                writer.close()
+                raise
+            self._idle.append(connection)
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def execute(self, *args):
+        """Sends one command and returns its reply."""
+        return (await self.pipeline([args]))[0]
+
+    async def close(self):
+        """Closes the idle connections."""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+# compares and swaps a refresh token digest atomically, keeping the key's expiry
+_ROTATE_REFRESH_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current then return -1 end
+if current ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[1], ARGV[2], 'PX', redis.call('PTTL', KEYS[1]))
+return 1
+"""
+
+
+class RedisSessionStore(SessionStore):
+    """Keeps sessions and revocations in a Redis-protocol server with native key expiry.
+
+    Each session is a key of its own, indexed per user by a sorted set scored by expiry.
+
+    Revocations are also appended to a sorted set scored by revocation time, which is
+    what workers read to sync their revocation index. Entries older than the token
+    lifetime can only belong to expired tokens and are trimmed by the reaper.
+    """
+
+    def __init__(self, client: RedisClient, prefix: str = "fasterapi:"):
+        self.client = client
+        self.prefix = prefix
+
+    def _ttl(self, exp: datetime) -> int:
+        return max(int((exp.timestamp() - time.time()) * 1000), 1)
+
+    async def create_session(
+        self,
+        db: AnySession,
+        session: SessionInfo,
+        limit: int = 0,
+        refresh_hash: Optional[str] = None,
+    ) -> List[SessionInfo]:
+        key = f"{self.prefix}user_sessions:{session.username}"
+        ttl = self._ttl(session.exp)
+        commands: List[Sequence] = [
+            (
+                "SET",
+                f"{self.prefix}session:{session.sid}",
+                session.model_dump_json(),
+                "PX",
+                ttl,
+            ),
+            ("ZADD", key, repr(session.exp.timestamp()), session.sid),
+            ("ZREMRANGEBYSCORE", key, "-inf", repr(time.time())),
+            ("PEXPIRE", key, ttl),
+        ]
+        if refresh_hash is not None:
+            commands.append(
+                ("SET", f"{self.prefix}refresh:{session.sid}", refresh_hash, "PX", ttl)
+            )
+        await self.client.pipeline(commands)
+        if limit <= 0:
+            return []
+        evicted = await self.client.execute("ZRANGE", key, 0, -(limit + 1))
+        return await self._delete(session.username, [sid.decode() for sid in evicted])
+
+    async def rotate_refresh_token(
+        self, db: AnySession, sid: str, presented_hash: str, new_hash: str
+    ) -> Optional[bool]:
+        rotated = await self.client.execute(
+            "EVAL",
+            _ROTATE_REFRESH_SCRIPT,
+            1,
+            f"{self.prefix}refresh:{sid}",
+            presented_hash,
+            new_hash,
+        )
+        return None if rotated < 0 else bool(rotated)
+
+    async def get_session(self, db: AnySession, sid: str) -> Optional[SessionInfo]:
+        session = await self.client.execute("GET", f"{self.prefix}session:{sid}")
+        return SessionInfo.model_validate_json(session) if session else None
+
+    async def list_sessions(self, db: AnySession, username: str) -> List[SessionInfo]:
+        key = f"{self.prefix}user_sessions:{username}"
+        _, sids = await self.client.pipeline(
+            [
+                ("ZREMRANGEBYSCORE", key, "-inf", repr(time.time())),
+                ("ZRANGE", key, 0, -1),
+            ]
+        )
+        if not sids:
+            return []
+        sessions = await self.client.execute(
+            "MGET", *[f"{self.prefix}session:{sid.decode()}" for sid in sids]
+        )
+        return sorted(
+            (
+                SessionInfo.model_validate_json(session)
+                for session in sessions
+                if session is not None
+            ),
+            key=lambda session: session.created_at,
+        )
+
+    async def delete_sessions(
+        self, db: AnySession, username: str, sids: Optional[List[str]] = None
+    ) -> List[SessionInfo]:
+        if sids is None:
+            members = await self.client.execute(
+                "ZRANGE", f"{self.prefix}user_sessions:{username}", 0, -1
+            )
+            sids = [sid.decode() for sid in members]
+        return await self._delete(username, sids)
+
+    async def _delete(self, username: str, sids: List[str]) -> List[SessionInfo]:
+        if not sids:
+            return []
+        keys = [f"{self.prefix}session:{sid}" for sid in sids]
+        sessions = [
+            SessionInfo.model_validate_json(session)
+            for session in await self.client.execute("MGET", *keys)
+            if session is not None
+        ]
+        # a session id given for another user is left alone
+        sessions = [session for session in sessions if session.username == username]
+        if sessions:
+            await self.client.pipeline(
+                [
+                    (
+                        "DEL",
+                        *[f"{self.prefix}session:{s.sid}" for s in sessions],
+                        *[f"{self.prefix}refresh:{s.sid}" for s in sessions],
+                    ),
+                    (
+                        "ZREM",
+                        f"{self.prefix}user_sessions:{username}",
+                        *[s.sid for s in sessions],
+                    ),
+                ]
+            )
+        return sessions
+
+    async def revoke(self, db: AnySession, digest: str, exp: datetime):
+        await self.client.pipeline(
+            [
+                ("SET", f"{self.prefix}revoked:{digest}", 1, "PX", self._ttl(exp)),
+                (
+                    "ZADD",
+                    f"{self.prefix}revocations",
+                    repr(time.time()),
+                    f"{digest}:{exp.timestamp()}",
+                ),
+            ]
+        )
+
+    async def is_revoked(self, db: AnySession, digest: str) -> bool:
+        return bool(
+            await self.client.execute("EXISTS", f"{self.prefix}revoked:{digest}")
+        )
+
+    async def revoked_since(
+        self, db: AnySession, cursor: float
+    ) -> List[Tuple[float, str, float]]:
+        reply = await self.client.execute(
+            "ZRANGEBYSCORE",
+            f"{self.prefix}revocations",
+            repr(max(cursor - REVOCATION_SYNC_OVERLAP, 0)),
+            "+inf",
+            "WITHSCORES",
+        )
+        now = time.time()
+        entries = []
+        for member, score in zip(reply[::2], reply[1::2]):
+            digest, exp = member.decode().split(":")
+            if float(exp) >= now:
+                entries.append((float(score), digest, float(exp)))
+        return entries
+
+    async def acquire_lease(
+        self, db: AnySession, name: str, owner: str, ttl: timedelta
+    ) -> bool:
+        key = f"{self.prefix}lease:{name}"
+        ttl_ms = int(ttl.total_seconds() * 1000)
+        if await self.client.execute("SET", key, owner, "NX", "PX", ttl_ms):
+            return True
+        holder = await self.client.execute("GET", key)
+        if holder is None or holder.decode() != owner:
+            return False
+        await self.client.execute("PEXPIRE", key, ttl_ms)
+        return True
+
+    async def reap(self, db: AnySession, batch_size: int) -> Dict[str, int]:
+        # sessions and revoked tokens expire natively, only the revocation log is trimmed
+        trimmed = await self.client.execute(
+            "ZREMRANGEBYSCORE",
+            f"{self.prefix}revocations",
+            "-inf",
+            repr(time.time() - TOKEN_EXPIRATION_TIME * 60),
+        )
+        return {"blacklisted_tokens": trimmed, "active_sessions": 0}
+
+    async def counts(self, db: AnySession) -> Dict[str, int]:
+        return {
+            "blacklisted_tokens": await self.client.execute(
+                "ZCARD", f"{self.prefix}revocations"
+            )
+        }
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_session_store(backend: str) -> SessionStore:
+    """Returns the session store of the backend, "sql", "memory" or "redis"."""
+    if backend == "sql":
+        return SqlSessionStore()
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "redis":
+        return RedisSessionStore(
+            RedisClient(SESSION_STORE_URL, SESSION_STORE_POOL_SIZE),
+            SESSION_STORE_PREFIX,
+        )
+    raise ValueError(f"Unknown session store {backend}.")
+
+
+session_store = create_session_store(SESSION_STORE)
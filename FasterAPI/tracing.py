@@ -0,0 +1,80 @@
+from typing import Optional
+
+from fastapi import FastAPI
+from opentelemetry import trace
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    SimpleSpanProcessor,
+    SpanProcessor,
+)
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+from . import logger
+from .metrics import Counter, registry
+from .settings import Settings
+
+
+class CountingBatchSpanProcessor(BatchSpanProcessor):
+    """A BatchSpanProcessor that counts the spans dropped because its queue was full."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dropped = 0
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if (
+            not self.done
+            and span.context.trace_flags.sampled
+            and len(self.queue) >= self.max_queue_size
+        ):
+            self.dropped += 1
+        super().on_end(span)
+
+
+span_processor: Optional[SpanProcessor] = None
+
+
+def setup_tracing(app: FastAPI, settings: Settings):
+    """Exports the spans of the app to an OTLP collector.
+
+    By default spans are exported in batches from a background thread, so a slow or
+    unreachable collector never adds latency to requests. When the batch queue is full
+    new spans are dropped and counted instead.
+    """
+    global span_processor
+    exporter = OTLPSpanExporter(endpoint=settings.TRACE_ENDPOINT, insecure=True)
+    if settings.TRACE_EXPORT == "simple":
+        span_processor = SimpleSpanProcessor(exporter)
+    else:
+        span_processor = CountingBatchSpanProcessor(
+            exporter,
+            max_queue_size=settings.TRACE_MAX_QUEUE_SIZE,
+            schedule_delay_millis=settings.TRACE_SCHEDULE_DELAY,
+            max_export_batch_size=settings.TRACE_MAX_EXPORT_BATCH_SIZE,
+            export_timeout_millis=settings.TRACE_EXPORT_TIMEOUT,
+        )
+    sample_ratio = settings.TRACE_SAMPLE_RATIO
+    trace_provider = TracerProvider(
+        resource=Resource(attributes={"service.name": settings.SVC_NAME}),
+        sampler=ParentBased(TraceIdRatioBased(sample_ratio)),
+    )
+    trace_provider.add_span_processor(span_processor)
+    trace.set_tracer_provider(tracer_provider=trace_provider)
+    FastAPIInstrumentor().instrument_app(app)
+    registry.register(
+        Counter(
+            "fasterapi_trace_spans_dropped_total",
+            "Spans dropped because the export queue was full.",
+            callback=dropped_spans,
+        )
+    )
+    logger.debug(f"Tracing enabled with sample ratio {sample_ratio}.")
+
+
+def dropped_spans() -> int:
+    """Returns the number of spans dropped because the export queue was full."""
+    return getattr(span_processor, "dropped", 0)
@@ -1,16 +1,26 @@
 import asyncio
-import pickle
+import secrets
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 
 from fastapi import HTTPException, status
-from jose import jwt
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
-from .essentials import (ALGORITHM, SECRET_KEY, TOKEN_EXPIRATION_TIME, get_db, logger,
-                         pwd_context)
-from .models import ActiveSession, BlacklistedToken, User
-from .schemas import UserCreate
+from .cache import session_digest, token_cache, token_digest, username_cache
+from .essentials import (ALLOW_MULTI_SESSIONS, KEY_ROTATION_INTERVAL, MAX_SESSIONS_PER_USER,
+                         REFRESH_TOKEN_EXPIRATION_TIME, REVOCATION_SYNC_INTERVAL,
+                         STATELESS_TOKENS, TOKEN_EXPIRATION_TIME, AnySession, logger, open_db,
+                         pwd_context, run_db)
+from .hashing import password_hasher
+from .keyring import decode_token, encode_token, keyring
+from .metrics import TOKEN_REFRESH_INVALID, TOKEN_REFRESH_REUSED, TOKEN_REFRESH_SUCCESS
+from .models import User, UserPrivilege
+from .replica import replica_router
+from .revocation import revocation_index
+from .store import session_store
+from .seed import append_seed
+from .schemas import BulkResult, PrivilegeGrant, SessionInfo, UserCreate
 
 
 def verify_password(plain_password, hashed_password):
@@ -18,78 +28,404 @@ def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
-async def authenticate_user(db: Session, username: str, password: str):
-    """Authenticates the user."""
-    user = db.query(User).filter(User.username == username).first()
+def get_user_by_username(db: Session, username: str) -> Optional[User]:
+    """Returns the user with the username, or None."""
+    return db.query(User).filter(User.username == username).first()
+
+
+_dummy_hash: Optional[str] = None
+
+
+async def dummy_hash() -> str:
+    """Returns a hash of a random password, computed once, to verify unknown users against."""
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = await password_hasher.hash(secrets.token_urlsafe(16))
+    return _dummy_hash
+
+
+async def authenticate_user(db: AnySession, username: str, password: str):
+    """Authenticates the user.
+
+    A password is verified whether or not the user exists, against a dummy hash for
+    unknown users, so the response time does not tell which usernames exist. Usernames
+    known to be missing skip the database lookup. Hashes made with an outdated scheme
+    or cost are replaced on a successful login.
+    """
+    user = None
+    if username_cache.get(username) is not False:
+        user = await run_db(db, get_user_by_username, username)
+        username_cache.put(username, user is not None)
     if not user:
+        await password_hasher.verify(password, await dummy_hash())
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await password_hasher.verify_and_update(
+        password, user.hashed_password
+    )
+    if not verified:
         return False
+    if new_hash is not None:
+
+        def _rehash(db: Session):
+            db.query(User).filter(User.id == user.id).update(
+                {User.hashed_password: new_hash}
+            )
+            db.commit()
+
+        await run_db(db, _rehash)
+        logger.debug(f"Password hash of user {username} upgraded.")
     return user
 
 
+def new_session_id() -> str:
+    """Returns a random id for a new session."""
+    return secrets.token_urlsafe(16)
+
+
+def user_claims(db: Session, user: User) -> dict:
+    """Returns the claims that let a stateless token be validated without the database."""
+    return {
+        "uid": user.id,
+        "given_name": user.first_name,
+        "family_name": user.last_name,
+        "email": user.email,
+        "su": user.is_superuser,
+        "scopes": [privilege.privilege for privilege in user.privileges],
+    }
+
+
 def create_access_token(data: dict):
     """Creates a JWT token for authenticated user."""
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=TOKEN_EXPIRATION_TIME)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = encode_token(to_encode)
     return encoded_jwt
 
 
-def create_session(token: str, db: Session, client: str):
-    """Activates the token upon user login."""
-    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    username = payload["sub"]
+def new_refresh_token(sid: str) -> str:
+    """Returns a new opaque refresh token of the session."""
+    return f"{sid}.{secrets.token_urlsafe(32)}"
+
+
+async def create_session(
+    token: str,
+    db: AnySession,
+    client: str,
+    user_agent: str = "",
+    refresh_token: Optional[str] = None,
+) -> SessionInfo:
+    """Activates the token upon user login.
+
+    The session is named by the token's sid claim. With a refresh token the session
+    lasts REFRESH_TOKEN_EXPIRATION_TIME and only the token's digest is stored,
+    otherwise it ends with the access token. The user's oldest sessions beyond
+    MAX_SESSIONS_PER_USER, or all other sessions if multiple sessions are not allowed,
+    are revoked.
+    """
+    payload = decode_token(token)
     exp = datetime.fromtimestamp(payload["exp"])
-    existing_active_session = (
-        db.query(ActiveSession).filter(
-            ActiveSession.username == username).first()
+    if refresh_token is not None:
+        exp = datetime.now() + timedelta(minutes=REFRESH_TOKEN_EXPIRATION_TIME)
+    session = SessionInfo(
+        sid=payload["sid"],
+        username=payload["sub"],
+        client=client,
+        user_agent=user_agent,
+        created_at=datetime.now(),
+        exp=exp,
     )
-    if existing_active_session:
-        existing_active_session.client = client  # type: ignore
-        existing_active_session.exp = exp  # type: ignore
-        db.commit()
-    else:
-        token_to_activate = ActiveSession(
-            username=username, client=client, exp=exp)
-        db.add(token_to_activate)
-        db.commit()
+    limit = 1 if ALLOW_MULTI_SESSIONS is False else MAX_SESSIONS_PER_USER
+    evicted = await session_store.create_session(
+        db,
+        session,
+        limit,
+        token_digest(refresh_token) if refresh_token is not None else None,
+    )
+    await revoke_sessions(db, evicted)
+    replica_router.note_write(session.username)
+    return session
+
+
+async def refresh_session(db: AnySession, refresh_token: str) -> Tuple[str, str]:
+    """Exchanges a refresh token for a new access token and a new refresh token.
+
+    Each refresh token is single use. Presenting one that was already exchanged means
+    it leaked, so the whole session is revoked along with every token issued for it.
+    No password is verified, so renewing a short-lived access token costs no hashing.
+    """
+    invalid_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+    )
+    sid = refresh_token.split(".", 1)[0]
+    new_token = new_refresh_token(sid)
+    rotated = await session_store.rotate_refresh_token(
+        db, sid, token_digest(refresh_token), token_digest(new_token)
+    )
+    if rotated is None:
+        TOKEN_REFRESH_INVALID.inc()
+        raise invalid_exception
+    session = await session_store.get_session(db, sid)
+    if session is None:
+        TOKEN_REFRESH_INVALID.inc()
+        raise invalid_exception
+    if not rotated:
+        TOKEN_REFRESH_REUSED.inc()
+        await end_sessions(db, session.username, [sid])
+        logger.warning(
+            f"Refresh token reused for session {sid} of {session.username}, session revoked."
+        )
+        raise invalid_exception
+    data = {"sub": session.username, "sid": sid}
+    if STATELESS_TOKENS:
+
+        def _user_claims(db: Session) -> Optional[dict]:
+            user = get_user_by_username(db, session.username)  # type: ignore
+            return user_claims(db, user) if user else None
 
+        claims = await run_db(db, _user_claims)
+        if claims is None:
+            TOKEN_REFRESH_INVALID.inc()
+            raise invalid_exception
+        data.update(claims)
+    TOKEN_REFRESH_SUCCESS.inc()
+    return create_access_token(data), new_token
 
-def blacklist_token(token: str, db: Session):
+
+async def revoke_sessions(db: AnySession, sessions: List[SessionInfo]):
+    """Revokes every token of the sessions, on other workers once they sync their revocation index."""
+    for session in sessions:
+        digest = session_digest(session.sid)
+        await session_store.revoke(db, digest, session.exp)
+        revocation_index.add_digest(bytes.fromhex(digest), session.exp.timestamp())
+        token_cache.invalidate_digest(digest)
+
+
+async def end_sessions(
+    db: AnySession, username: str, sids: Optional[List[str]] = None
+) -> List[SessionInfo]:
+    """Deletes and revokes the sessions of the user with the ids, or all of them."""
+    sessions = await session_store.delete_sessions(db, username, sids)
+    await revoke_sessions(db, sessions)
+    replica_router.note_write(username)
+    return sessions
+
+
+async def blacklist_token(token: str, db: AnySession):
     """Blacklists the token upon user logout."""
-    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    payload = decode_token(token)
     exp = datetime.fromtimestamp(payload["exp"])
-    token_to_blacklist = BlacklistedToken(token=token, exp=exp)
-    db.add(token_to_blacklist)
-    db.commit()
+    await session_store.revoke(db, token_digest(token), exp)
+    revocation_index.add(token, exp.timestamp())
+
+
+async def load_revocation_index(db: AnySession) -> int:
+    """Adds the unexpired blacklisted tokens not seen yet to the revocation index.
+
+    Returns the number of tokens added. Tokens revoked by other workers are dropped
+    from the local token cache as they are picked up.
+    """
+    entries = []
+    for cursor, token_hash, exp in await session_store.revoked_since(
+        db, revocation_index.last_id
+    ):
+        entries.append((cursor, bytes.fromhex(token_hash), exp))
+        token_cache.invalidate_digest(token_hash)
+    revocation_index.load(entries)
+    return len(entries)
 
 
-def register_user(user: UserCreate):
+async def register_user(user: UserCreate):
     """Registers a new user."""
-    db = next(get_db())
-    extsing_user = db.query(User).filter(
-        User.username == user.username).first()
-    if extsing_user:
-        raise HTTPException(
-            status_code=status.HTTP_406_NOT_ACCEPTABLE,
-            detail="User already exists.",
+
+    def _add_user(db: Session, hashed_password: str):
+        new_user = User(
+            username=user.username,
+            hashed_password=hashed_password,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            email=user.email,
+            is_superuser=user.is_superuser,
         )
-    new_user = User(
-        username=user.username,
-        hashed_password=pwd_context.hash(user.password),
-        first_name=user.first_name,
-        last_name=user.last_name,
-        email=user.email,
-        is_superuser=user.is_superuser,
-    )
-    db.add(new_user)
-    db.commit()
+        db.add(new_user)
+        db.commit()
+
+    async with open_db() as db:
+        extsing_user = await run_db(db, get_user_by_username, user.username)
+        if extsing_user:
+            raise HTTPException(
+                status_code=status.HTTP_406_NOT_ACCEPTABLE,
+                detail="User already exists.",
+            )
+        hashed_password = await password_hasher.hash(user.password)
+        await run_db(db, _add_user, hashed_password)
+    username_cache.put(user.username, True)
     logger.debug(f"User {user.username} registered.")
     return user
 
 
+# rows per IN query or multi-row insert, well below the bound parameter limits of all backends
+BULK_CHUNK_SIZE = 500
+
+
+def _existing_usernames(db: Session, usernames: List[str]) -> Set[str]:
+    """Returns which of the usernames already exist, one IN query per chunk."""
+    existing: Set[str] = set()
+    for i in range(0, len(usernames), BULK_CHUNK_SIZE):
+        chunk = usernames[i : i + BULK_CHUNK_SIZE]
+        existing.update(
+            username
+            for (username,) in db.query(User.username).filter(User.username.in_(chunk))
+        )
+    return existing
+
+
+async def register_users(users: List[UserCreate]) -> List[BulkResult]:
+    """Registers a batch of users in one transaction.
+
+    Existing users are looked up with a single IN query, passwords of the new users
+    are hashed in parallel and all of them are inserted with multi-row statements.
+    Returns the result of each user, in order.
+    """
+    results: List[BulkResult] = []
+    new_users: List[Tuple[int, UserCreate]] = []
+    async with open_db() as db:
+        existing = await run_db(
+            db, _existing_usernames, list({user.username for user in users})
+        )
+        seen: Set[str] = set()
+        for index, user in enumerate(users):
+            if user.username in existing:
+                results.append(
+                    BulkResult(
+                        index=index,
+                        username=user.username,
+                        status="exists",
+                        detail="User already exists.",
+                    )
+                )
+            elif user.username in seen:
+                results.append(
+                    BulkResult(
+                        index=index,
+                        username=user.username,
+                        status="duplicate",
+                        detail="User appears more than once in the batch.",
+                    )
+                )
+            else:
+                seen.add(user.username)
+                new_users.append((index, user))
+                results.append(
+                    BulkResult(
+                        index=index,
+                        username=user.username,
+                        status="created",
+                    )
+                )
+        hashed_passwords = await password_hasher.hash_many(
+            [user.password for _, user in new_users]
+        )
+
+        def _insert_users(db: Session):
+            rows = [
+                {
+                    "username": user.username,
+                    "hashed_password": hashed_password,
+                    "first_name": user.first_name,
+                    "last_name": user.last_name,
+                    "email": user.email,
+                    "is_superuser": user.is_superuser,
+                }
+                for (_, user), hashed_password in zip(new_users, hashed_passwords)
+            ]
+            for i in range(0, len(rows), BULK_CHUNK_SIZE):
+                db.execute(insert(User), rows[i : i + BULK_CHUNK_SIZE])
+            db.commit()
+
+        if new_users:
+            await run_db(db, _insert_users)
+    for _, user in new_users:
+        username_cache.put(user.username, True)
+    logger.debug(f"{len(new_users)} of {len(users)} users registered.")
+    return results
+
+
+async def grant_privileges(grants: List[PrivilegeGrant]) -> List[BulkResult]:
+    """Grants a batch of privileges in one transaction.
+
+    Users and their existing privileges are looked up with one IN query each, and the
+    missing privileges are inserted with multi-row statements. Returns the result of
+    each grant, in order.
+    """
+
+    def _grant_privileges(db: Session) -> List[BulkResult]:
+        usernames = list({grant.username for grant in grants})
+        user_ids: Dict[str, int] = {}
+        held: Set[Tuple[int, str]] = set()
+        for i in range(0, len(usernames), BULK_CHUNK_SIZE):
+            chunk = usernames[i : i + BULK_CHUNK_SIZE]
+            user_ids.update(
+                (username, user_id)
+                for user_id, username in db.query(User.id, User.username).filter(
+                    User.username.in_(chunk)
+                )
+            )
+        ids = list(user_ids.values())
+        for i in range(0, len(ids), BULK_CHUNK_SIZE):
+            held.update(
+                (user_id, privilege)
+                for user_id, privilege in db.query(
+                    UserPrivilege.user_id, UserPrivilege.privilege
+                ).filter(UserPrivilege.user_id.in_(ids[i : i + BULK_CHUNK_SIZE]))
+            )
+        results: List[BulkResult] = []
+        rows = []
+        for index, grant in enumerate(grants):
+            user_id = user_ids.get(grant.username)
+            if user_id is None:
+                results.append(
+                    BulkResult(
+                        index=index,
+                        username=grant.username,
+                        status="error",
+                        detail="User not found",
+                    )
+                )
+            elif (user_id, grant.privilege) in held:
+                results.append(
+                    BulkResult(
+                        index=index,
+                        username=grant.username,
+                        status="exists",
+                        detail="Privilege already granted",
+                    )
+                )
+            else:
+                held.add((user_id, grant.privilege))
+                rows.append({"user_id": user_id, "privilege": grant.privilege})
+                results.append(
+                    BulkResult(
+                        index=index,
+                        username=grant.username,
+                        status="granted",
+                    )
+                )
+        for i in range(0, len(rows), BULK_CHUNK_SIZE):
+            db.execute(insert(UserPrivilege), rows[i : i + BULK_CHUNK_SIZE])
+        db.commit()
+        return results
+
+    async with open_db() as db:
+        results = await run_db(db, _grant_privileges)
+    for result in results:
+        if result.status == "granted":
+            token_cache.invalidate_user(result.username)
+            replica_router.note_write(result.username)
+    return results
+
+
 def create_superuser(
     username: str,
     password: str,
@@ -106,21 +442,7 @@ def create_superuser(
         password=password,
         is_superuser=True,
     )
-
-    def _load_superusers() -> List[UserCreate]:
-        try:
-            with open(".superuser", "rb") as f:
-                return pickle.load(f)
-        except FileNotFoundError:
-            return []
-
-    def _save_superusers(superusers: List[UserCreate]):
-        with open(".superuser", "wb") as f:
-            pickle.dump(superusers, f)
-
-    superusers = _load_superusers()
-    superusers.append(superuser)
-    _save_superusers(superusers)
+    append_seed([superuser])
 
 
 def create_user(
@@ -139,32 +461,34 @@ def create_user(
         password=password,
         is_superuser=False,
     )
+    append_seed([user])
 
-    def _load_users() -> List[UserCreate]:
-        try:
-            with open(".users", "rb") as f:
-                return pickle.load(f)
-        except FileNotFoundError:
-            return []
-
-    def _save_users(users: List[UserCreate]):
-        with open(".users", "wb") as f:
-            pickle.dump(users, f)
 
-    users = _load_users()
-    users.append(user)
-    _save_users(users)
+def create_users(users: List[UserCreate]):
+    """Creates a batch of users, superusers included."""
+    append_seed(users)
 
 
 # define neccessary functions
-async def _clean_up_expired_tokens():
-    """A async task to cleanup expired tokens from the database. Maintains a optimal performance."""
+async def _sync_revocation_index():
+    """A async task to pick up tokens blacklisted by other workers into the revocation index."""
     while True:
-        db = next(get_db())
-        db.query(BlacklistedToken).filter(
-            BlacklistedToken.exp < datetime.now()
-        ).delete()
-        db.commit()
-        db.close()
-        logger.debug("Expired tokens cleaned up.")
-        await asyncio.sleep(TOKEN_EXPIRATION_TIME * 60)
+        await asyncio.sleep(REVOCATION_SYNC_INTERVAL)
+        try:
+            async with open_db() as db:
+                await load_revocation_index(db)
+        except Exception as e:
+            logger.warning(f"Failed to sync the revocation index: {e}")
+
+
+async def _rotate_signing_keys(rotate: bool = True):
+    """A async task to rotate the asymmetric signing key on schedule, or only reload the keys if rotate is False."""
+    while True:
+        try:
+            if rotate:
+                keyring.maybe_rotate()  # type: ignore
+            else:
+                keyring.load()  # type: ignore
+        except Exception as e:
+            logger.warning(f"Failed to rotate the signing key: {e}")
+        await asyncio.sleep(min(KEY_ROTATION_INTERVAL * 3600, 3600))